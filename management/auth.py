@@ -2,8 +2,7 @@ import base64, os, os.path, hmac, json
 
 from flask import make_response
 
-import utils
-from mailconfig import get_mail_password, get_mail_user_privileges
+from mailconfig import get_mail_password, get_mail_user_privileges, verify_password
 from mfa import get_hash_mfa_state, validate_auth_mfa
 
 DEFAULT_KEY_PATH   = '/var/lib/mailinabox/api.key'
@@ -102,16 +101,7 @@ class KeyAuthService:
 			pw_hash = get_mail_password(email, env)
 
 			# Authenticate.
-			try:
-				# Use 'doveadm pw' to check credentials. doveadm will return
-				# a non-zero exit status if the credentials are no good,
-				# and check_call will raise an exception in that case.
-				utils.shell('check_call', [
-					"/usr/bin/doveadm", "pw",
-					"-p", pw,
-					"-t", pw_hash,
-					])
-			except:
+			if not verify_password(pw, pw_hash):
 				# Login failed.
 				raise ValueError("Invalid password.")
 
@@ -9,6 +9,11 @@
 import sys, getpass, urllib.request, urllib.error, json, re, csv
 
 def mgmt(cmd, data=None, is_json=False):
+	# Commands that change users or aliases pass wait=1 so that they return
+	# only once the daemon has finished updating the system configuration
+	# (DNS, nginx, ...), which it otherwise does in the background. Setup
+	# scripts rely on the configuration being current when they continue.
+
 	# The base URL for the management daemon. (Listens on IPv4 only.)
 	mgmt_uri = 'http://127.0.0.1:10222'
 
@@ -62,6 +67,7 @@ if len(sys.argv) < 2:
 	print("""Usage:
   {cli} user                                     (lists users)
   {cli} user add user@domain.com [password]
+  {cli} user import users.csv                    (adds users from lines of email,password[,privileges])
   {cli} user password user@domain.com [password]
   {cli} user remove user@domain.com
   {cli} user make-admin user@domain.com
@@ -73,6 +79,7 @@ if len(sys.argv) < 2:
   {cli} alias add incoming.name@domain.com sent.to@other.domain.com
   {cli} alias add incoming.name@domain.com 'sent.to@other.domain.com, multiple.people@other.domain.com'
   {cli} alias remove incoming.name@domain.com
+  {cli} alias import aliases.csv                 (adds aliases from lines of address,forwards_to[,permitted_senders])
 
 Removing a mail user does not delete their mail folders on disk. It only prevents IMAP/SMTP login.
 """.format(
@@ -101,12 +108,16 @@ elif sys.argv[1] == "user" and sys.argv[2] in ("add", "password"):
 		email, pw = sys.argv[3:5]
 
 	if sys.argv[2] == "add":
-		print(mgmt("/mail/users/add", { "email": email, "password": pw }))
+		print(mgmt("/mail/users/add", { "email": email, "password": pw, "wait": "1" }))
 	elif sys.argv[2] == "password":
 		print(mgmt("/mail/users/password", { "email": email, "password": pw }))
 
+elif sys.argv[1] == "user" and sys.argv[2] == "import" and len(sys.argv) == 4:
+	with open(sys.argv[3]) as f:
+		print(mgmt("/mail/users/import", { "users": f.read(), "wait": "1" }))
+
 elif sys.argv[1] == "user" and sys.argv[2] == "remove" and len(sys.argv) == 4:
-	print(mgmt("/mail/users/remove", { "email": sys.argv[3] }))
+	print(mgmt("/mail/users/remove", { "email": sys.argv[3], "wait": "1" }))
 
 elif sys.argv[1] == "user" and sys.argv[2] in ("make-admin", "remove-admin") and len(sys.argv) == 4:
 	if sys.argv[2] == "make-admin":
@@ -139,10 +150,14 @@ elif sys.argv[1] == "alias" and len(sys.argv) == 2:
 	print(mgmt("/mail/aliases"))
 
 elif sys.argv[1] == "alias" and sys.argv[2] == "add" and len(sys.argv) == 5:
-	print(mgmt("/mail/aliases/add", { "address": sys.argv[3], "forwards_to": sys.argv[4] }))
+	print(mgmt("/mail/aliases/add", { "address": sys.argv[3], "forwards_to": sys.argv[4], "wait": "1" }))
+
+elif sys.argv[1] == "alias" and sys.argv[2] == "import" and len(sys.argv) == 4:
+	with open(sys.argv[3]) as f:
+		print(mgmt("/mail/aliases/import", { "aliases": f.read(), "wait": "1" }))
 
 elif sys.argv[1] == "alias" and sys.argv[2] == "remove" and len(sys.argv) == 4:
-	print(mgmt("/mail/aliases/remove", { "address": sys.argv[3] }))
+	print(mgmt("/mail/aliases/remove", { "address": sys.argv[3], "wait": "1" }))
 
 else:
 	print("Invalid command-line arguments.")
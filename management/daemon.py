@@ -7,7 +7,7 @@
 # DEBUG=1 management/daemon.py
 # service mailinabox start # when done debugging, start it up again
 
-import os, os.path, re, json, time
+import os, os.path, re, json, time, csv, io, hashlib
 import multiprocessing.pool, subprocess
 
 from functools import wraps
@@ -15,15 +15,19 @@ from functools import wraps
 from flask import Flask, request, render_template, abort, Response, send_from_directory, make_response
 
 import auth, utils
-from mailconfig import get_mail_users, get_mail_users_ex, get_admins, add_mail_user, set_mail_password, remove_mail_user
-from mailconfig import get_mail_user_privileges, add_remove_mail_user_privilege
-from mailconfig import get_mail_aliases, get_mail_aliases_ex, get_mail_domains, add_mail_alias, remove_mail_alias
+from mailconfig import get_mail_users, get_admins, add_mail_user, set_mail_password, remove_mail_user
+from mailconfig import get_mail_user_privileges, add_remove_mail_user_privilege, import_mail_users
+from mailconfig import get_mail_aliases, get_mail_domains, add_mail_alias, remove_mail_alias, import_mail_aliases
+from mailconfig import KickWorker, get_mail_users_page, get_mail_aliases_page, get_mail_users_version
 from mfa import get_public_mfa_state, provision_totp, validate_totp_secret, enable_mfa, disable_mfa
 
 env = utils.load_environment()
 
 auth_service = auth.KeyAuthService()
 
+# Updates DNS and nginx in the background after users and aliases change.
+kick_worker = KickWorker(env)
+
 # We may deploy via a symbolic link, which confuses flask's template finding.
 me = __file__
 try:
@@ -104,6 +108,21 @@ def unauthorized(error):
 def json_response(data, status=200):
 	return Response(json.dumps(data, indent=2, sort_keys=True)+'\n', status=status, mimetype='application/json')
 
+def read_csv_records(data, columns):
+	# Reads the records of an imported CSV file as tuples of the given
+	# columns. Missing trailing columns are empty, blank lines are skipped,
+	# and so is a header row that starts with the name of the first column.
+	records = []
+	for row in csv.reader(io.StringIO(data)):
+		if "".join(row).strip() == "":
+			continue
+		if len(records) == 0 and row[0].strip().lower() == columns[0]:
+			continue
+		if len(row) > len(columns):
+			raise ValueError("Record %d has more than %d columns (%s)." % (len(records) + 1, len(columns), ", ".join(columns)))
+		records.append(tuple(row) + ("",) * (len(columns) - len(row)))
+	return records
+
 ###################################
 
 # Control Panel (unauthenticated views)
@@ -165,22 +184,72 @@ def me():
 
 # MAIL
 
+def mail_listing_response(version, get_page):
+	# Returns a page of the JSON listing of users or aliases, filtered by the
+	# domain and prefix query parameters, and paginated by offset and limit.
+	# The total number of matching entries is in the X-Total-Count header.
+	# The listing only changes with version, so its ETag is derived from it
+	# and clients that already have the listing get a 304 without it being
+	# read again.
+	try:
+		offset = int(request.args.get('offset', 0))
+		limit = int(request.args['limit']) if request.args.get('limit') else None
+	except ValueError:
+		return ("Invalid offset or limit.", 400)
+	if offset < 0 or (limit is not None and limit < 1):
+		return ("Invalid offset or limit.", 400)
+
+	etag = hashlib.sha1(repr((version, request.full_path)).encode("utf8")).hexdigest()
+	if request.if_none_match.contains(etag):
+		response = Response(status=304)
+	else:
+		page, total = get_page(domain=request.args.get('domain'), prefix=request.args.get('prefix'), offset=offset, limit=limit)
+		response = json_response(page)
+		response.headers["X-Total-Count"] = str(total)
+	response.set_etag(etag)
+	return response
+
 @app.route('/mail/users')
 @authorized_personnel_only
 def mail_users():
 	if request.args.get("format", "") == "json":
-		return json_response(get_mail_users_ex(env, with_archived=True))
+		return mail_listing_response(get_mail_users_version(env, with_archived=True),
+			lambda **kwargs : get_mail_users_page(env, with_archived=True, **kwargs))
 	else:
 		return "".join(x+"\n" for x in get_mail_users(env))
 
+def kick_in_background(result):
+	# Queues the DNS and nginx update after a change to users or aliases
+	# and returns right away with the job ID. Clients that pass wait=1 get
+	# the full output of the update, as before.
+	if isinstance(result, tuple): return result # error
+	job_id = kick_worker.schedule(result)
+	headers = { "X-Job-Id": str(job_id) }
+	if request.form.get('wait', '') == '1':
+		job = kick_worker.get_job(job_id, wait=600)
+		if job["status"] == "finished":
+			return (job["result"], 200, headers)
+		elif job["status"] == "failed":
+			return (job["result"], 500, headers)
+	return (result + "\nThe system configuration will be updated in the background (job %d).\n" % job_id, 200, headers)
+
 @app.route('/mail/users/add', methods=['POST'])
 @authorized_personnel_only
 def mail_users_add():
 	try:
-		return add_mail_user(request.form.get('email', ''), request.form.get('password', ''), request.form.get('privileges', ''), env)
+		return kick_in_background(add_mail_user(request.form.get('email', ''), request.form.get('password', ''), request.form.get('privileges', ''), env, do_kick=False))
 	except ValueError as e:
 		return (str(e), 400)
 
+@app.route('/mail/users/import', methods=['POST'])
+@authorized_personnel_only
+def mail_users_import():
+	try:
+		users = read_csv_records(request.form.get('users', ''), ("email", "password", "privileges"))
+	except (ValueError, csv.Error) as e:
+		return (str(e), 400)
+	return kick_in_background(import_mail_users(users, env, do_kick=False))
+
 @app.route('/mail/users/password', methods=['POST'])
 @authorized_personnel_only
 def mail_users_password():
@@ -192,7 +261,7 @@ def mail_users_password():
 @app.route('/mail/users/remove', methods=['POST'])
 @authorized_personnel_only
 def mail_users_remove():
-	return remove_mail_user(request.form.get('email', ''), env)
+	return kick_in_background(remove_mail_user(request.form.get('email', ''), env, do_kick=False))
 
 
 @app.route('/mail/users/privileges')
@@ -217,25 +286,49 @@ def mail_user_privs_remove():
 @authorized_personnel_only
 def mail_aliases():
 	if request.args.get("format", "") == "json":
-		return json_response(get_mail_aliases_ex(env))
+		return mail_listing_response(get_mail_users_version(env),
+			lambda **kwargs : get_mail_aliases_page(env, **kwargs))
 	else:
 		return "".join(address+"\t"+receivers+"\t"+(senders or "")+"\n" for address, receivers, senders in get_mail_aliases(env))
 
 @app.route('/mail/aliases/add', methods=['POST'])
 @authorized_personnel_only
 def mail_aliases_add():
-	return add_mail_alias(
+	return kick_in_background(add_mail_alias(
 		request.form.get('address', ''),
 		request.form.get('forwards_to', ''),
 		request.form.get('permitted_senders', ''),
 		env,
-		update_if_exists=(request.form.get('update_if_exists', '') == '1')
-		)
+		update_if_exists=(request.form.get('update_if_exists', '') == '1'),
+		do_kick=False
+		))
+
+@app.route('/mail/aliases/import', methods=['POST'])
+@authorized_personnel_only
+def mail_aliases_import():
+	try:
+		aliases = read_csv_records(request.form.get('aliases', ''), ("address", "forwards_to", "permitted_senders"))
+	except (ValueError, csv.Error) as e:
+		return (str(e), 400)
+	return kick_in_background(import_mail_aliases(aliases, env, update_if_exists=(request.form.get('update_if_exists', '') == '1'), do_kick=False))
 
 @app.route('/mail/aliases/remove', methods=['POST'])
 @authorized_personnel_only
 def mail_aliases_remove():
-	return remove_mail_alias(request.form.get('address', ''), env)
+	return kick_in_background(remove_mail_alias(request.form.get('address', ''), env, do_kick=False))
+
+@app.route('/mail/jobs/<int:job_id>')
+@authorized_personnel_only
+def mail_job_status(job_id):
+	# Long-poll for the job to be done when wait is given, up to a minute.
+	try:
+		wait = min(max(float(request.args.get('wait', 0)), 0), 60)
+	except ValueError:
+		return ("Invalid wait.", 400)
+	job = kick_worker.get_job(job_id, wait=wait)
+	if job is None:
+		return ("Job not found.", 404)
+	return json_response(job)
 
 @app.route('/mail/domains')
 @authorized_personnel_only
@@ -4,13 +4,14 @@
 # and mail aliases and restarts nsd.
 ########################################################################
 
-import sys, os, os.path, urllib.parse, datetime, re, hashlib, base64
+import sys, os, os.path, urllib.parse, datetime, re, hashlib, base64, shutil, tempfile, json, glob, threading
+import multiprocessing.pool
 import ipaddress
 import rtyaml
 import dns.resolver
 
 from mailconfig import get_mail_domains, get_mail_aliases
-from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains
+from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains, get_config_snapshot, clear_config_snapshots, get_file_version, serialized_system_update
 from ssl_certificates import get_ssl_certificates, check_certificate
 
 # From https://stackoverflow.com/questions/3026957/how-to-validate-a-domain-name-using-regex-php/16491074#16491074
@@ -28,6 +29,9 @@ def get_dns_domains(env):
 	return domains
 
 def get_dns_zones(env):
+	return [list(zone) for zone in get_config_snapshot(env).get("dns_zones", lambda : load_dns_zones(env))]
+
+def load_dns_zones(env):
 	# What domains should we create DNS zones for? Never create a zone for
 	# a domain & a subdomain of that domain.
 	domains = get_dns_domains(env)
@@ -57,37 +61,33 @@ def get_dns_zones(env):
 
 	return zonefiles
 
+@serialized_system_update
 def do_dns_update(env, force=False):
 	# Write zone files.
 	os.makedirs('/etc/nsd/zones', exist_ok=True)
-	zonefiles = []
-	updated_domains = []
-	for (domain, zonefile, records) in build_zones(env):
-		# The final set of files will be signed.
-		zonefiles.append((domain, zonefile + ".signed"))
-
-		# See if the zone has changed, and if so update the serial number
-		# and write the zone file.
-		if not write_nsd_zone(domain, "/etc/nsd/zones/" + zonefile, records, env, force):
-			# Zone was not updated. There were no changes.
-			continue
-
-		# Mark that we just updated this domain.
-		updated_domains.append(domain)
+	zonefiles = get_dns_zones(env)
 
-		# Sign the zone.
-		#
-		# Every time we sign the zone we get a new result, which means
-		# we can't sign a zone without bumping the zone's serial number.
-		# Thus we only sign a zone if write_nsd_zone returned True
-		# indicating the zone changed, and thus it got a new serial number.
-		# write_nsd_zone is smart enough to check if a zone's signature
-		# is nearing expiration and if so it'll bump the serial number
-		# and return True so we get a chance to re-sign it.
-		sign_zone(domain, zonefile, env)
-
-	# Write the main nsd.conf file.
-	if write_nsd_conf(zonefiles, list(get_custom_dns_config(env)), env):
+	# Only rebuild the zones whose inputs changed since they were last
+	# written, or whose signatures are nearing expiration. See
+	# get_zone_fingerprints.
+	fingerprints = get_zone_fingerprints(zonefiles, env)
+	if not force:
+		zonefiles_to_update = [(domain, zonefile) for (domain, zonefile) in zonefiles
+			if not is_zone_current("/etc/nsd/zones/" + zonefile, fingerprints[zonefile])]
+	else:
+		zonefiles_to_update = zonefiles
+	zones = list(build_zones(env, zonefiles_to_update))
+
+	# Update the zones several at a time. Signing runs ldns-signzone for
+	# each zone, and when the signatures near expiration every zone needs
+	# signing at once. The work is done by the ldns processes, so threads
+	# are enough to run them in parallel.
+	with multiprocessing.pool.ThreadPool(processes=os.cpu_count() or 1) as pool:
+		updated = pool.starmap(update_zone, [(domain, zonefile, records, env, force, fingerprints[zonefile]) for (domain, zonefile, records) in zones])
+	updated_domains = [domain for (domain, zonefile, records), zone_updated in zip(zones, updated) if zone_updated]
+
+	# Write the main nsd.conf file. The final set of files will be signed.
+	if write_nsd_conf([(domain, zonefile + ".signed") for (domain, zonefile) in zonefiles], list(get_custom_dns_config(env)), env):
 		# Make sure updated_domains contains *something* if we wrote an updated
 		# nsd.conf so that we know to restart nsd.
 		if len(updated_domains) == 0:
@@ -115,12 +115,126 @@ def do_dns_update(env, force=False):
 	else:
 		return "updated DNS: " + ",".join(updated_domains) + "\n"
 
+def update_zone(domain, zonefile, records, env, force, fingerprint=None):
+	# See if the zone has changed, and if so update the serial number
+	# and write the zone file.
+	if not write_nsd_zone(domain, "/etc/nsd/zones/" + zonefile, records, env, force):
+		# Zone was not updated. There were no changes.
+		write_zone_fingerprint("/etc/nsd/zones/" + zonefile, fingerprint)
+		return False
+
+	# Sign the zone.
+	#
+	# Every time we sign the zone we get a new result, which means
+	# we can't sign a zone without bumping the zone's serial number.
+	# Thus we only sign a zone if write_nsd_zone returned True
+	# indicating the zone changed, and thus it got a new serial number.
+	# write_nsd_zone is smart enough to check if a zone's signature
+	# is nearing expiration and if so it'll bump the serial number
+	# and return True so we get a chance to re-sign it.
+	sign_zone(domain, zonefile, env)
+	write_zone_fingerprint("/etc/nsd/zones/" + zonefile, fingerprint)
+	return True
+
 ########################################################################
 
-def build_zones(env):
-	# What domains (and their zone filenames) should we build?
+def get_zone_fingerprints(zonefiles, env):
+	# Returns a hash of everything that build_zone and sign_zone read for
+	# each zone, so that a zone whose hash is the same as when it was last
+	# written need not be built again. A change to one alias then doesn't
+	# rebuild every zone, which for PRIMARY_HOSTNAME's zone means running
+	# ssh-keyscan and parsing the TLS certificate.
 	domains = get_dns_domains(env)
-	zonefiles = get_dns_zones(env)
+	additional_records = list(get_custom_dns_config(env))
+	from web_update import get_web_domains
+	www_redirect_domains = set(get_web_domains(env)) - set(get_web_domains(env, include_www_redirects=False))
+	mail_domains = get_mail_domains(env)
+	user_domains = get_mail_domains(env, users_only=True)
+
+	# Inputs of every zone: the settings, the secondary nameservers, the
+	# DKIM key, the MTA-STS policy, the DNSSEC keys, and this file so
+	# that zones are rebuilt when Mail-in-a-Box is upgraded.
+	files = [
+		os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt'),
+		"/var/lib/mailinabox/mta-sts.txt",
+		os.path.abspath(__file__),
+	]
+	files += glob.glob(os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/*'))
+	common_inputs = {
+		"env": [env.get(key) for key in ("PRIMARY_HOSTNAME", "PUBLIC_IP", "PUBLIC_IPV6", "MTA_STS_TLSRPT_RUA")],
+		"secondary_dns": get_secondary_dns(additional_records, mode="NS"),
+		"files": { fn: get_file_version(fn) for fn in files },
+	}
+
+	# PRIMARY_HOSTNAME's TLSA and SSHFP records come from the TLS certificate
+	# and the SSH host keys (and the port sshd listens on).
+	files = [os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem"), "/etc/ssh/sshd_config"]
+	files += glob.glob("/etc/ssh/ssh_host_*_key.pub")
+	primary_hostname_inputs = { fn: get_file_version(fn) for fn in files }
+
+	# Mail domains get MTA-STS records if their certificates are valid,
+	# which depends on the files in the ssl directory and, because they
+	# expire, on the date.
+	certificate_inputs = {
+		"files": { os.path.join(path, fn): get_file_version(os.path.join(path, fn))
+			for path, dirs, fns in os.walk(os.path.join(env["STORAGE_ROOT"], "ssl")) for fn in fns },
+		"date": datetime.datetime.utcnow().strftime("%Y%m%d"),
+	}
+
+	# Group the domains and the custom records by the zone they are in.
+	zones = { domain: { "domains": [], "www_redirect_domains": [], "mail_domains": [], "user_domains": [], "records": [] }
+		for domain, zonefile in zonefiles }
+	def get_zone(domain):
+		while domain not in zones:
+			if "." not in domain: return None
+			domain = domain.split(".", 1)[1]
+		return domain
+	for key, values in (("domains", domains), ("www_redirect_domains", www_redirect_domains),
+	                    ("mail_domains", mail_domains), ("user_domains", user_domains)):
+		for d in sorted(values):
+			zone = get_zone(d)
+			if zone is not None:
+				zones[zone][key].append(d)
+	for record in additional_records:
+		zone = get_zone(record[0])
+		if zone is not None:
+			zones[zone]["records"].append(record)
+
+	fingerprints = { }
+	for domain, zonefile in zonefiles:
+		inputs = dict(zones[domain])
+		inputs["common"] = common_inputs
+		inputs["domain"] = domain
+		inputs["records"] = list(filter_custom_records(domain, inputs["records"]))
+		if get_zone(env["PRIMARY_HOSTNAME"]) == domain:
+			inputs["primary_hostname"] = primary_hostname_inputs
+		if inputs["mail_domains"]:
+			inputs["certificates"] = certificate_inputs
+		fingerprints[zonefile] = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf8")).hexdigest()
+	return fingerprints
+
+def is_zone_current(zonefile, fingerprint):
+	# Is the zone file up to date: written from inputs with the same
+	# fingerprint, and signed with signatures that aren't expiring soon?
+	try:
+		with open(zonefile + ".fingerprint") as f:
+			if f.read().strip() != fingerprint:
+				return False
+	except FileNotFoundError:
+		return False
+	return os.path.exists(zonefile) and not is_zone_signature_expiring(zonefile)
+
+def write_zone_fingerprint(zonefile, fingerprint):
+	if fingerprint is None: return
+	with open(zonefile + ".fingerprint", "w") as f:
+		f.write(fingerprint + "\n")
+
+def build_zones(env, zonefiles=None):
+	# What domains (and their zone filenames) should we build? All of
+	# them, unless zonefiles lists the zones to build.
+	domains = get_dns_domains(env)
+	if zonefiles is None:
+		zonefiles = get_dns_zones(env)
 
 	# Custom records to add to zones.
 	additional_records = list(get_custom_dns_config(env))
@@ -391,18 +505,22 @@ def build_tlsa_record(env):
 	from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 
 	fn = os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem")
-	cert = load_pem(load_cert_chain(fn)[0])
 
-	subject_public_key = cert.public_key().public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
-	# We could have also loaded ssl_private_key.pem and called priv_key.public_key().public_bytes(...)
+	def build():
+		cert = load_pem(load_cert_chain(fn)[0])
+
+		subject_public_key = cert.public_key().public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+		# We could have also loaded ssl_private_key.pem and called priv_key.public_key().public_bytes(...)
 
-	pk_hash = hashlib.sha256(subject_public_key).hexdigest()
+		pk_hash = hashlib.sha256(subject_public_key).hexdigest()
 
-	# Specify the TLSA parameters:
-	# 3: Match the (leaf) certificate. (No CA, no trust path needed.)
-	# 1: Match its subject public key.
-	# 1: Use SHA256.
-	return "3 1 1 " + pk_hash
+		# Specify the TLSA parameters:
+		# 3: Match the (leaf) certificate. (No CA, no trust path needed.)
+		# 1: Match its subject public key.
+		# 1: Use SHA256.
+		return "3 1 1 " + pk_hash
+
+	return get_derived_records(("TLSA", fn), [fn], build)
 
 def build_sshfp_records():
 	# The SSHFP record is a way for us to embed this server's SSH public
@@ -429,30 +547,57 @@ def build_sshfp_records():
 	# to the zone file (that trigger bumping the serial number). However,
 	# if SSH has been configured to listen on a nonstandard port, we must
 	# specify that port to sshkeyscan.
-	port = 22
-	with open('/etc/ssh/sshd_config', 'r') as f:
-		for line in f:
-			s = line.rstrip().split()
-			if len(s) == 2 and s[0] == 'Port':
-				try:
-					port = int(s[1])
-				except ValueError:
-					pass
-				break
-	keys = shell("check_output", ["ssh-keyscan", "-t", "rsa,dsa,ecdsa,ed25519", "-p", str(port), "localhost"])
-	for key in sorted(keys.split("\n")):
-		if key.strip() == "" or key[0] == "#": continue
-		try:
-			host, keytype, pubkey = key.split(" ")
-			yield "%d %d ( %s )" % (
-				algorithm_number[keytype],
-				2, # specifies we are using SHA-256 on next line
-				hashlib.sha256(base64.b64decode(pubkey)).hexdigest().upper(),
-				)
-		except:
-			# Lots of things can go wrong. Don't let it disturb the DNS
-			# zone.
-			pass
+	#
+	# ssh-keyscan takes a while, so the records are kept until the SSH
+	# configuration or host keys change.
+	def build():
+		port = 22
+		with open('/etc/ssh/sshd_config', 'r') as f:
+			for line in f:
+				s = line.rstrip().split()
+				if len(s) == 2 and s[0] == 'Port':
+					try:
+						port = int(s[1])
+					except ValueError:
+						pass
+					break
+		keys = shell("check_output", ["ssh-keyscan", "-t", "rsa,dsa,ecdsa,ed25519", "-p", str(port), "localhost"])
+		records = []
+		for key in sorted(keys.split("\n")):
+			if key.strip() == "" or key[0] == "#": continue
+			try:
+				host, keytype, pubkey = key.split(" ")
+				records.append("%d %d ( %s )" % (
+					algorithm_number[keytype],
+					2, # specifies we are using SHA-256 on next line
+					hashlib.sha256(base64.b64decode(pubkey)).hexdigest().upper(),
+					))
+			except:
+				# Lots of things can go wrong. Don't let it disturb the DNS
+				# zone.
+				pass
+		return records
+
+	files = ['/etc/ssh/sshd_config'] + sorted(glob.glob('/etc/ssh/ssh_host_*'))
+	return list(get_derived_records("SSHFP", files, build))
+
+derived_records = { }
+derived_records_lock = threading.Lock()
+
+def get_derived_records(key, files, build):
+	# Returns build(), which derives DNS records from the files, calling
+	# it again only once any of the files have changed. The results are
+	# kept for as long as the management daemon runs. Empty results aren't
+	# kept, in case they came from a service that wasn't up yet.
+	version = [get_file_version(fn) for fn in files]
+	with derived_records_lock:
+		if key in derived_records and derived_records[key][0] == version:
+			return derived_records[key][1]
+	value = build()
+	if value:
+		with derived_records_lock:
+			derived_records[key] = (version, value)
+	return value
 
 ########################################################################
 
@@ -507,28 +652,7 @@ $TTL 1800           ; default time to live
 	# We don't see the DNSSEC records yet, so we have to figure out
 	# if a re-signing is necessary so we can prematurely bump the
 	# serial number.
-	force_bump = False
-	if not os.path.exists(zonefile + ".signed"):
-		# No signed file yet. Shouldn't normally happen unless a box
-		# is going from not using DNSSEC to using DNSSEC.
-		force_bump = True
-	else:
-		# We've signed the domain. Check if we are close to the expiration
-		# time of the signature. If so, we'll force a bump of the serial
-		# number so we can re-sign it.
-		with open(zonefile + ".signed") as f:
-			signed_zone = f.read()
-		expiration_times = re.findall(r"\sRRSIG\s+SOA\s+\d+\s+\d+\s\d+\s+(\d{14})", signed_zone)
-		if len(expiration_times) == 0:
-			# weird
-			force_bump = True
-		else:
-			# All of the times should be the same, but if not choose the soonest.
-			expiration_time = min(expiration_times)
-			expiration_time = datetime.datetime.strptime(expiration_time, "%Y%m%d%H%M%S")
-			if expiration_time - datetime.datetime.now() < datetime.timedelta(days=3):
-				# We're within three days of the expiration, so bump serial & resign.
-				force_bump = True
+	force_bump = is_zone_signature_expiring(zonefile)
 
 	# Set the serial number.
 	serial = datetime.datetime.now().strftime("%Y%m%d00")
@@ -564,6 +688,27 @@ $TTL 1800           ; default time to live
 
 	return True # file is updated
 
+def is_zone_signature_expiring(zonefile):
+	if not os.path.exists(zonefile + ".signed"):
+		# No signed file yet. Shouldn't normally happen unless a box
+		# is going from not using DNSSEC to using DNSSEC.
+		return True
+
+	# We've signed the domain. Check if we are close to the expiration
+	# time of the signature. If so, the zone must be re-signed.
+	with open(zonefile + ".signed") as f:
+		signed_zone = f.read()
+	expiration_times = re.findall(r"\sRRSIG\s+SOA\s+\d+\s+\d+\s\d+\s+(\d{14})", signed_zone)
+	if len(expiration_times) == 0:
+		# weird
+		return True
+
+	# All of the times should be the same, but if not choose the soonest.
+	expiration_time = min(expiration_times)
+	expiration_time = datetime.datetime.strptime(expiration_time, "%Y%m%d%H%M%S")
+	# Are we within three days of the expiration?
+	return expiration_time - datetime.datetime.now() < datetime.timedelta(days=3)
+
 def get_dns_zonefile(zone, env):
 	for domain, fn in get_dns_zones(env):
 		if zone == domain:
@@ -636,67 +781,61 @@ def sign_zone(domain, zonefile, env):
 	# can reuse the same key, but it won't validate without a DNSSEC
 	# record specifically for the domain.
 	#
-	# Copy the .key and .private files to /tmp to patch them up.
-	#
-	# Use os.umask and open().write() to securely create a copy that only
-	# we (root) can read.
-	files_to_kill = []
-	for key in ("KSK", "ZSK"):
-		if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
-		oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
-		newkeyfn = '/tmp/' + dnssec_keys[key].replace("_domain_", domain)
-		dnssec_keys[key] = newkeyfn
-		for ext in (".private", ".key"):
-			if not os.path.exists(oldkeyfn + ext): raise Exception("DNSSEC is not properly set up.")
-			with open(oldkeyfn + ext, "r") as fr:
-				keydata = fr.read()
-			keydata = keydata.replace("_domain_", domain) # trick ldns-signkey into letting our generic key be used by this zone
-			fn = newkeyfn + ext
-			prev_umask = os.umask(0o77) # ensure written file is not world-readable
-			try:
-				with open(fn, "w") as fw:
+	# Copy the .key and .private files to a temporary directory of this
+	# zone's own to patch them up. Zones are signed in parallel, so the
+	# copies are created readable only by us (root) with os.open rather
+	# than by changing the process-wide umask.
+	tmpdir = tempfile.mkdtemp(prefix="dnssec-")
+	try:
+		for key in ("KSK", "ZSK"):
+			if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
+			oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
+			newkeyfn = os.path.join(tmpdir, dnssec_keys[key].replace("_domain_", domain))
+			dnssec_keys[key] = newkeyfn
+			for ext in (".private", ".key"):
+				if not os.path.exists(oldkeyfn + ext): raise Exception("DNSSEC is not properly set up.")
+				with open(oldkeyfn + ext, "r") as fr:
+					keydata = fr.read()
+				keydata = keydata.replace("_domain_", domain) # trick ldns-signkey into letting our generic key be used by this zone
+				with open(os.open(newkeyfn + ext, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w") as fw:
 					fw.write(keydata)
-			finally:
-				os.umask(prev_umask) # other files we write should be world-readable
-			files_to_kill.append(fn)
-
-	# Do the signing.
-	expiry_date = (datetime.datetime.now() + datetime.timedelta(days=30)).strftime("%Y%m%d")
-	shell('check_call', ["/usr/bin/ldns-signzone",
-		# expire the zone after 30 days
-		"-e", expiry_date,
-
-		# use NSEC3
-		"-n",
-
-		# zonefile to sign
-		"/etc/nsd/zones/" + zonefile,
-
-		# keys to sign with (order doesn't matter -- it'll figure it out)
-		dnssec_keys["KSK"],
-		dnssec_keys["ZSK"],
-	])
-
-	# Create a DS record based on the patched-up key files. The DS record is specific to the
-	# zone being signed, so we can't use the .ds files generated when we created the keys.
-	# The DS record points to the KSK only. Write this next to the zone file so we can
-	# get it later to give to the user with instructions on what to do with it.
-	#
-	# We want to be able to validate DS records too, but multiple forms may be valid depending
-	# on the digest type. So we'll write all (both) valid records. Only one DS record should
-	# actually be deployed. Preferebly the first.
-	with open("/etc/nsd/zones/" + zonefile + ".ds", "w") as f:
-		for digest_type in ('2', '1'):
-			rr_ds = shell('check_output', ["/usr/bin/ldns-key2ds",
-				"-n", # output to stdout
-				"-" + digest_type, # 1=SHA1, 2=SHA256
-				dnssec_keys["KSK"] + ".key"
-			])
-			f.write(rr_ds)
-
-	# Remove our temporary file.
-	for fn in files_to_kill:
-		os.unlink(fn)
+
+		# Do the signing.
+		expiry_date = (datetime.datetime.now() + datetime.timedelta(days=30)).strftime("%Y%m%d")
+		shell('check_call', ["/usr/bin/ldns-signzone",
+			# expire the zone after 30 days
+			"-e", expiry_date,
+
+			# use NSEC3
+			"-n",
+
+			# zonefile to sign
+			"/etc/nsd/zones/" + zonefile,
+
+			# keys to sign with (order doesn't matter -- it'll figure it out)
+			dnssec_keys["KSK"],
+			dnssec_keys["ZSK"],
+		])
+
+		# Create a DS record based on the patched-up key files. The DS record is specific to the
+		# zone being signed, so we can't use the .ds files generated when we created the keys.
+		# The DS record points to the KSK only. Write this next to the zone file so we can
+		# get it later to give to the user with instructions on what to do with it.
+		#
+		# We want to be able to validate DS records too, but multiple forms may be valid depending
+		# on the digest type. So we'll write all (both) valid records. Only one DS record should
+		# actually be deployed. Preferebly the first.
+		with open("/etc/nsd/zones/" + zonefile + ".ds", "w") as f:
+			for digest_type in ('2', '1'):
+				rr_ds = shell('check_output', ["/usr/bin/ldns-key2ds",
+					"-n", # output to stdout
+					"-" + digest_type, # 1=SHA1, 2=SHA256
+					dnssec_keys["KSK"] + ".key"
+				])
+				f.write(rr_ds)
+	finally:
+		# Remove our temporary files.
+		shutil.rmtree(tmpdir)
 
 ########################################################################
 
@@ -754,6 +893,9 @@ def write_opendkim_tables(domains, env):
 ########################################################################
 
 def get_custom_dns_config(env):
+	yield from get_config_snapshot(env).get("custom_dns", lambda : list(load_custom_dns_config(env)))
+
+def load_custom_dns_config(env):
 	try:
 		custom_dns = rtyaml.load(open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')))
 		if not isinstance(custom_dns, dict): raise ValueError() # caught below
@@ -839,6 +981,7 @@ def write_custom_dns_config(config, env):
 	config_yaml = rtyaml.dump(dns)
 	with open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml'), "w") as f:
 		f.write(config_yaml)
+	clear_config_snapshots()
 
 def set_custom_dns_record(qname, rtype, value, action, env):
 	# validate qname
@@ -1,13 +1,24 @@
 #!/usr/local/lib/mailinabox/env/bin/python
 import argparse
+import array
+import contextlib
+import copy
+import csv
 import datetime
+import functools
 import gzip
+import heapq
+import io
+import json
+import math
+import multiprocessing.pool
 import os.path
+import random
 import re
-import shutil
-import tempfile
+import sqlite3
+import sys
 import textwrap
-from collections import defaultdict, OrderedDict
+from collections import Counter, defaultdict, deque, OrderedDict
 
 import dateutil.parser
 import time
@@ -27,6 +38,13 @@ LOG_FILES = (
     '/var/log/mail.log',
 )
 
+# Size of the read buffer used when reading the (possibly compressed) log files
+READ_BUFFER_SIZE = 1024 * 1024
+
+# When bisecting an uncompressed log file for the start of the time span, stop once the range is
+# this small and scan the rest
+BISECT_MIN_BYTES = 64 * 1024
+
 TIME_DELTAS = OrderedDict([
     ('all', datetime.timedelta(weeks=52)),
     ('month', datetime.timedelta(weeks=4)),
@@ -44,12 +62,47 @@ TIME_DELTAS = OrderedDict([
     ('today', datetime.datetime.now() - datetime.datetime.now().replace(hour=0, minute=0, second=0))
 ])
 
+# The time the script was started. Syslog timestamps don't have a year, which is derived from this.
+# Only change it with set_now().
+NOW = datetime.datetime.now()
+
+# Month abbreviations as used in the syslog timestamps
+MONTHS = {month: i + 1 for i, month in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"))}
+
 # Start date > end date!
-START_DATE = datetime.datetime.now()
+START_DATE = NOW
 END_DATE = None
 
 VERBOSE = False
 
+# Number of processes that scan the log files in parallel
+JOBS = 1
+
+# Limits of the table of messages that are followed through the mail queue. Messages that weren't
+# removed from the queue within the lifetime of the queue are dropped.
+QUEUE_MAX_IN_FLIGHT = 10000
+QUEUE_EXPIRY = datetime.timedelta(days=5)
+QUEUE_SAMPLES = 1000  # Number of delivery latencies kept per hour or domain for the percentiles
+QUEUE_TOP_DOMAINS = 50  # Number of recipient domains the latency is reported for
+
+# Keep the memory use flat for periods with a lot of blocked and greylisted email, by keeping a
+# random sample of the blocked emails and only the most frequent greylisted senders of every user
+BOUNDED = False
+BOUNDED_SAMPLES = 100  # Number of blocked emails kept per user
+BOUNDED_TOP_K = 100  # Number of greylisted (client, sender) pairs kept per user
+
+# Follow the live log file and report the activity of a rolling time span, as a 'table' or 'json'
+FOLLOW = None
+FOLLOW_INTERVAL = 10  # Seconds between the reports
+FOLLOW_BUCKETS = 60  # Number of parts the rolling time span is collected in
+
+# Answer the report from the persistent index instead of scanning the log files
+USE_INDEX = False
+
+# Location of the persistent index of the log files, relative to STORAGE_ROOT
+INDEX_FILE = 'mail/mail_log_index.sqlite'
+
 # List of strings to filter users with
 FILTERS = None
 
@@ -59,6 +112,48 @@ SCAN_IN = True  # Incoming email
 SCAN_DOVECOT_LOGIN = True  # Dovecot Logins
 SCAN_GREY = False  # Greylisted email
 SCAN_BLOCKED = False  # Rejected email
+SCAN_ABUSE = False  # Bursts of suspicious activity
+SCAN_QUEUE = False  # Delivery of the messages through the mail queue
+
+# Thresholds of the abuse detection. Activity is counted in a sliding window of an hour.
+ABUSE_WINDOW = datetime.timedelta(hours=1)
+ABUSE_MAX_HOSTS = 5  # Distinct hosts a user sends email from
+ABUSE_MAX_FAILED_LOGINS = 10  # Failed logins from a single IP address
+ABUSE_BASELINE_HOURS = 24  # Hours of history of a user before its sending rate is judged
+ABUSE_SPIKE_FACTOR = 5  # Times the user's average hourly sending rate
+ABUSE_SPIKE_MIN = 20  # Emails per hour that are never considered a spike
+ABUSE_MAX_USERS = 10000  # Users whose sending rate is tracked, the least recently sending first to go
+
+# Services that don't log anything of interest. Their lines are rejected with a cheap prefix check
+# on the raw line, before any regular expression runs.
+IGNORED_SERVICES = ("postfix/qmgr", "postfix/pickup", "postfix/cleanup", "postfix/scache", "spampd",
+                    "postfix/anvil", "postfix/master", "opendkim", "postfix/tlsmgr", "anvil")
+IGNORED_SERVICE_PREFIXES = tuple(service + delimiter for service in IGNORED_SERVICES
+                                 for delimiter in ("[", ":"))
+# The queue manager logs the size and removal of the messages, which are needed for following
+# the messages through the queue
+QUEUE_IGNORED_SERVICE_PREFIXES = tuple(prefix for prefix in IGNORED_SERVICE_PREFIXES
+                                       if not prefix.startswith("postfix/qmgr"))
+
+# Precompiled patterns of the log lines
+LOG_LINE_PATTERN = re.compile(r"(\w+[\s]+\d+ \d+:\d+:\d+) ([\w]+ )?([\w\-/]+)[^:]*: (.*)")
+POSTGREY_PATTERN = re.compile(r"action=(greylist|pass), reason=(.*?), (?:delay=\d+, )?"
+                              r"client_name=(.*), client_address=(.*), sender=(.*), recipient=(.*)")
+SMTPD_REJECT_PATTERN = re.compile(r"NOQUEUE: reject: RCPT from .*?: (.*?); from=<(.*?)> to=<(.*?)>")
+SPAMHAUS_IP_PATTERN = re.compile(r"Client host \[(.*?)\] blocked using zen.spamhaus.org; (.*)")
+SPAMHAUS_DOMAIN_PATTERN = re.compile(r"Sender address \[.*@(.*)\] blocked using dbl.spamhaus.org; (.*)")
+DOVECOT_LOGIN_PATTERN = re.compile(r"Info: Login: user=<(.*?)>, method=PLAIN, rip=(.*?),")
+DOVECOT_AUTH_FAILED_PATTERN = re.compile(
+    r"(?:Info: )?(?:Disconnected|Aborted login) \(auth failed, (\d+) attempts[^)]*\): .*?rip=([^,]+)")
+SASL_FAILED_PATTERN = re.compile(r"warning: (\S+)\[(\S+)\]: SASL \S+ authentication failed")
+LMTP_SAVED_PATTERN = re.compile(r"([A-Z0-9]+): to=<(\S+)>, .* Saved")
+QUEUE_CLIENT_PATTERN = re.compile(r"([0-9A-Za-z]+): client=")
+QMGR_PATTERN = re.compile(r"([0-9A-Za-z]+): (?:from=<.*?>, size=(\d+), nrcpt=(\d+)|(removed))")
+DELIVERY_PATTERN = re.compile(r"([0-9A-Za-z]+): to=<(.*?)>,.*? delay=([\d.]+),.*? status=(\w+)")
+# Match both the 'plain' and 'login' sasl methods, since both authentication methods are allowed by
+# Dovecot
+SUBMISSION_PATTERN = re.compile(
+    r"([A-Z0-9]+): client=(\S+), sasl_method=(PLAIN|LOGIN), sasl_username=(\S+)")
 
 
 def scan_files(collector):
@@ -68,19 +163,19 @@ def scan_files(collector):
 
     for fn in LOG_FILES:
 
-        tmp_file = None
-
         if not os.path.exists(fn):
             continue
-        elif fn[-3:] == '.gz':
-            tmp_file = tempfile.NamedTemporaryFile()
-            shutil.copyfileobj(gzip.open(fn), tmp_file)
+
+        offset = find_scan_offset(fn)
+
+        if offset is None:
+            # All lines are older than the time span
+            continue
 
         if VERBOSE:
             print("Processing file", fn, "...")
-        fn = tmp_file.name if tmp_file else fn
 
-        for line in readline(fn):
+        for line in readline(fn, offset):
             if scan_mail_log_line(line.strip(), collector) is False:
                 if stop_scan:
                     return
@@ -89,18 +184,412 @@ def scan_files(collector):
                 stop_scan = False
 
 
+def scan_files_parallel(collector):
+    """ Scan the files in a pool of processes and merge the results in the order of the files
 
-def scan_mail_log(env):
-    """ Scan the system's mail log files and collect interesting data
+    Every file is scanned into a collector of its own. Merging those in the order of the files gives
+    the same result as scanning them one after the other.
 
-    This function scans the 2 most recent mail log files in /var/log/.
+    """
 
-    Args:
-        env (dict): Dictionary containing MiaB settings
+    files = [fn for fn in LOG_FILES if os.path.exists(fn) and find_scan_offset(fn) is not None]
+
+    with multiprocessing.pool.Pool(processes=JOBS) as pool:
+        results = pool.imap(scan_file, [(fn, collector["known_addresses"]) for fn in files])
+
+        stop_scan = False
+
+        for fn, (partial, first_stop, last_stop, halted) in zip(files, results):
+            if VERBOSE:
+                print("Processing file", fn, "...")
+
+            if stop_scan and first_stop:
+                # A serial scan would have halted on the first line of this file
+                collector["scan_count"] += 1
+                return
+
+            merge_collectors(collector, partial)
+
+            if halted:
+                return
+
+            stop_scan = last_stop
+
+
+def scan_file(args):
+    """ Scan a single file into a new collector, for scan_files_parallel
+
+    Besides the collector, returns whether the scan would stop at the first and at the last line of
+    the file, and whether the scan halted within the file.
+
+    """
+
+    fn, known_addresses = args
+    collector = new_collector(known_addresses)
+    first_stop = stop_scan = None
+
+    for line in readline(fn, find_scan_offset(fn)):
+        if scan_mail_log_line(line.strip(), collector) is False:
+            if stop_scan:
+                return collector, first_stop, True, True
+            stop_scan = True
+        else:
+            stop_scan = False
+
+        if first_stop is None:
+            first_stop = stop_scan
+
+    return collector, bool(first_stop), bool(stop_scan), False
+
+
+def merge_collectors(collector, partial):
+    """ Merge the collector of a later part of the logs into the collector """
+
+    collector["scan_count"] += partial["scan_count"]
+    collector["parse_count"] += partial["parse_count"]
+    collector["other-services"] |= partial["other-services"]
+    collector["abuse"].merge(partial["abuse"])
+    collector["queue"].merge(partial["queue"])
+
+    for kind, activity in partial["activity"].items():
+        collector["activity"][kind].merge(activity)
+
+    for kind in ("sent_mail", "received_mail", "logins", "rejected"):
+        for user, data in partial[kind].items():
+            if user not in collector[kind]:
+                collector[kind][user] = data
+                continue
+
+            merged = collector[kind][user]
+            merged["latest"] = data["latest"]
+
+            if kind == "sent_mail":
+                merged["sent_count"] += data["sent_count"]
+                merged["hosts"] |= data["hosts"]
+            elif kind == "received_mail":
+                merged["received_count"] += data["received_count"]
+            elif kind == "rejected":
+                merged["count"] += data["count"]
+                merged["blocked"].extend(data["blocked"])
+                continue
+
+            if kind == "logins":
+                for key in ("totals_by_protocol", "totals_by_protocol_and_host"):
+                    for protocol_name, count in data[key].items():
+                        merged[key][protocol_name] += count
+
+    for user, data in partial["postgrey"].items():
+        if user not in collector["postgrey"]:
+            collector["postgrey"][user] = data
+            continue
+
+        rep = collector["postgrey"][user]
+        for key, (first_date, delivered_date) in data.items():
+            if key in rep:
+                # The latest greylisting and delivery win, as they would in a serial scan
+                first_date = first_date or rep[key][0]
+                delivered_date = delivered_date or rep[key][1]
+            if isinstance(rep, HeavyHitters):
+                rep.add(key, (first_date, delivered_date), data.counts[key])
+            else:
+                rep[key] = (first_date, delivered_date)
+
+
+
+def open_index(env):
+    """ Open the persistent index of the log files, creating it if it doesn't exist yet
+
+    The index holds per user, per hour counters of the interesting log lines and the position in
+    each log file up to which it was built, so that later runs only have to parse new lines.
 
     """
 
-    collector = {
+    conn = sqlite3.connect(os.path.join(env["STORAGE_ROOT"], INDEX_FILE))
+    conn.execute("CREATE TABLE IF NOT EXISTS activity (hour TEXT NOT NULL, user TEXT NOT NULL, "
+                 "kind TEXT NOT NULL, protocol TEXT NOT NULL, host TEXT NOT NULL, "
+                 "count INTEGER NOT NULL, first_seen TEXT NOT NULL, last_seen TEXT NOT NULL, "
+                 "PRIMARY KEY (hour, user, kind, protocol, host))")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (inode INTEGER PRIMARY KEY, path TEXT NOT NULL, "
+                 "head TEXT NOT NULL, offset INTEGER NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS boundary (date TEXT NOT NULL, line TEXT NOT NULL, "
+                 "count INTEGER NOT NULL)")
+    return conn
+
+
+def update_index(env, collector):
+    """ Parse the log lines that were added since the last run into the persistent index
+
+    Files are recognized by their inode and first line, so they are still known after logrotate
+    renamed them, and parsing resumes at the byte offset reached in the previous run. Files that
+    are not known yet (i.e. new files and freshly compressed ones) are parsed from the start, but
+    only lines newer than the newest line in the index are counted. The lines of the newest second
+    are kept in the index too, so that new lines of that same second are still counted.
+
+    """
+
+    conn = open_index(env)
+    c = conn.cursor()
+
+    c.execute("SELECT date, line, count FROM boundary")
+    rows = c.fetchall()
+    if rows:
+        newest = rows[0][0]
+        newest_lines = Counter({line: count for date, line, count in rows})
+    else:
+        # An empty index, or one that was built before the lines of the newest second were kept,
+        # in which case all lines of that second are taken as counted
+        c.execute("SELECT MAX(last_seen) FROM activity")
+        newest = c.fetchone()[0]
+        newest_lines = None
+
+    # The lines of the newest second counted so far, including those of previous runs
+    boundary_date, boundary_lines = newest, Counter(newest_lines or ())
+
+    c.execute("SELECT inode, head, offset FROM files")
+    known_files = {inode: (head, offset) for inode, head, offset in c.fetchall()}
+    files = []
+
+    # The counters are kept per hour, so collect the data of one hour at a time and flush it to
+    # the index when the hour changes
+    hour_collector = new_collector(collector["known_addresses"])
+    hour = None
+
+    with unfiltered_scan():
+        for fn in LOG_FILES:
+
+            if not os.path.exists(fn):
+                continue
+
+            inode = os.stat(fn).st_ino
+            head = read_first_line(fn)
+            known_file = known_files.get(inode)
+
+            if known_file is not None and known_file[0] != head:
+                # The inode was reused for another file
+                known_file = None
+
+            if known_file is not None and fn[-3:] == '.gz':
+                # Compressed files don't change, so there is nothing new in there
+                files.append((inode, fn, head, known_file[1]))
+                continue
+            elif known_file is not None and known_file[1] <= os.path.getsize(fn):
+                # Continue where we left off
+                offset, since, seen = known_file[1], None, None
+            else:
+                # A new file, or it was truncated in the meantime
+                offset, since = 0, newest
+                seen = Counter(newest_lines) if newest_lines is not None else None
+
+            if VERBOSE:
+                print("Indexing file", fn, "...")
+
+            for line, offset in read_new_lines(fn, offset):
+                line = line.strip()
+                entry = parse_mail_log_line(line)
+
+                if entry is None:
+                    continue
+
+                date, service, log = entry
+                stamp = format_date(date)
+
+                if since is not None and stamp <= since:
+                    if stamp < since or seen is None:
+                        # Already counted in a previous run
+                        continue
+                    if seen[line] > 0:
+                        # Same second as the newest line in the index, and counted along with it
+                        seen[line] -= 1
+                        continue
+
+                if boundary_date is None or stamp > boundary_date:
+                    boundary_date, boundary_lines = stamp, Counter()
+                if stamp == boundary_date:
+                    boundary_lines[line] += 1
+
+                collector["scan_count"] += 1
+
+                if date.replace(minute=0, second=0) != hour:
+                    write_index_hour(c, hour, hour_collector)
+                    hour_collector = new_collector(collector["known_addresses"])
+                    hour = date.replace(minute=0, second=0)
+
+                if scan_log_entry(date, service, log, hour_collector):
+                    collector["parse_count"] += 1
+
+            files.append((inode, fn, head, offset))
+
+    write_index_hour(c, hour, hour_collector)
+
+    # Forget about files that are gone and counters that are older than the longest time span
+    c.execute("DELETE FROM files")
+    c.executemany("INSERT OR REPLACE INTO files (inode, path, head, offset) VALUES (?, ?, ?, ?)",
+                  files)
+    if boundary_lines:
+        c.execute("DELETE FROM boundary")
+        c.executemany("INSERT INTO boundary (date, line, count) VALUES (?, ?, ?)",
+                      [(boundary_date, line, count) for line, count in boundary_lines.items()])
+    c.execute("DELETE FROM activity WHERE hour < ?",
+              (format_date(NOW - TIME_DELTAS['all']),))
+
+    conn.commit()
+    conn.close()
+
+
+def write_index_hour(c, hour, collector):
+    """ Add the counters collected for a single hour to the index """
+
+    if hour is None:
+        return
+
+    rows = []
+
+    for user, data in collector["sent_mail"].items():
+        rows.append((user, "sent", "", "", data["sent_count"], data["earliest"], data["latest"]))
+
+    for user, data in collector["received_mail"].items():
+        rows.append((user, "received", "", "", data["received_count"], data["earliest"],
+                     data["latest"]))
+
+    for user, data in collector["logins"].items():
+        for (protocol_name, host), count in data["totals_by_protocol_and_host"].items():
+            rows.append((user, "login", protocol_name, host, count, data["earliest"],
+                         data["latest"]))
+
+    for user, data in collector["postgrey"].items():
+        dates = [first_date for first_date, _ in data.values() if first_date]
+        if dates:
+            rows.append((user, "greylist", "", "", len(dates), min(dates), max(dates)))
+
+    for user, data in collector["rejected"].items():
+        rows.append((user, "rejected", "", "", data["count"], data["earliest"],
+                     data["latest"]))
+
+    for user, kind, protocol_name, host, count, earliest, latest in rows:
+        # An hour can be spread over several runs (or files), so add to any existing counters
+        key = (format_date(hour), user, kind, protocol_name, host)
+        c.execute("INSERT OR IGNORE INTO activity (hour, user, kind, protocol, host, count, "
+                  "first_seen, last_seen) VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                  key + (format_date(earliest), format_date(latest)))
+        c.execute("UPDATE activity SET count = count + ?, first_seen = MIN(first_seen, ?), "
+                  "last_seen = MAX(last_seen, ?) WHERE hour = ? AND user = ? AND kind = ? "
+                  "AND protocol = ? AND host = ?",
+                  (count, format_date(earliest), format_date(latest)) + key)
+
+
+def load_index(env, collector):
+    """ Fill the collector with the counters from the index for the time span of the report
+
+    The index has a resolution of an hour, so the time span is extended to whole hours.
+
+    """
+
+    conn = open_index(env)
+    c = conn.cursor()
+    window = (format_date(END_DATE.replace(minute=0, second=0, microsecond=0)),
+              format_date(START_DATE))
+
+    # Totals by hour of the day
+    c.execute("SELECT CAST(SUBSTR(hour, 12, 2) AS INTEGER), user, kind, protocol, SUM(count), "
+              "MIN(first_seen), MAX(last_seen) FROM activity WHERE hour >= ? AND hour < ? "
+              "GROUP BY 1, 2, 3, 4", window)
+
+    for hour, user, kind, protocol_name, count, first_seen, last_seen in c.fetchall():
+
+        if not user_match(user):
+            continue
+
+        first_seen = parse_date(first_seen)
+        last_seen = parse_date(last_seen)
+
+        if kind == "sent" and SCAN_OUT:
+            data = collector["sent_mail"].setdefault(user, {
+                "sent_count": 0,
+                "hosts": set(),
+                "earliest": first_seen,
+                "latest": None,
+            })
+            data["sent_count"] += count
+            collector["activity"]["sent_mail"].add(user, "sent", hour, count)
+        elif kind == "received" and SCAN_IN:
+            data = collector["received_mail"].setdefault(user, {
+                "received_count": 0,
+                "earliest": first_seen,
+                "latest": None,
+            })
+            data["received_count"] += count
+            collector["activity"]["received_mail"].add(user, "received", hour, count)
+        elif kind == "login" and (SCAN_OUT if protocol_name == "smtp" else SCAN_DOVECOT_LOGIN):
+            data = collector["logins"].setdefault(user, {
+                "earliest": first_seen,
+                "latest": None,
+                "totals_by_protocol": defaultdict(int),
+                "totals_by_protocol_and_host": defaultdict(int),
+            })
+            data["totals_by_protocol"][protocol_name] += count
+            collector["activity"]["logins"].add(user, protocol_name, hour, count)
+        elif kind == "greylist" and SCAN_GREY:
+            data = collector["postgrey"].setdefault(user, {
+                "count": 0,
+                "earliest": first_seen,
+                "latest": None,
+            })
+            data["count"] += count
+        elif kind == "rejected" and SCAN_BLOCKED:
+            data = collector["rejected"].setdefault(user, {
+                "blocked": [],
+                "count": 0,
+                "earliest": first_seen,
+                "latest": None,
+            })
+            data["count"] += count
+        else:
+            continue
+
+        data["earliest"] = min(data["earliest"], first_seen)
+        data["latest"] = max(data["latest"] or last_seen, last_seen)
+
+    # Totals by login host
+    c.execute("SELECT user, protocol, host, SUM(count) FROM activity "
+              "WHERE hour >= ? AND hour < ? AND kind = 'login' GROUP BY 1, 2, 3", window)
+
+    for user, protocol_name, host, count in c.fetchall():
+
+        data = collector["logins"].get(user)
+        if data and protocol_name in data["totals_by_protocol"]:
+            data["totals_by_protocol_and_host"][(protocol_name, host)] += count
+
+        if user in collector["sent_mail"] and protocol_name == "smtp":
+            # Every sent email is also logged as an smtp login from the sending host
+            collector["sent_mail"][user]["hosts"].add(host)
+
+    conn.close()
+
+
+@contextlib.contextmanager
+def unfiltered_scan():
+    """ Temporarily scan for everything of every user, regardless of the command line options """
+
+    global FILTERS, SCAN_OUT, SCAN_IN, SCAN_DOVECOT_LOGIN, SCAN_GREY, SCAN_BLOCKED, SCAN_ABUSE
+    global SCAN_QUEUE
+
+    saved = (FILTERS, SCAN_OUT, SCAN_IN, SCAN_DOVECOT_LOGIN, SCAN_GREY, SCAN_BLOCKED, SCAN_ABUSE,
+             SCAN_QUEUE)
+    FILTERS = None
+    SCAN_OUT = SCAN_IN = SCAN_DOVECOT_LOGIN = SCAN_GREY = SCAN_BLOCKED = True
+    # The index doesn't store the results of the abuse detection and the mail queue
+    SCAN_ABUSE = SCAN_QUEUE = False
+    try:
+        yield
+    finally:
+        (FILTERS, SCAN_OUT, SCAN_IN, SCAN_DOVECOT_LOGIN, SCAN_GREY, SCAN_BLOCKED, SCAN_ABUSE,
+         SCAN_QUEUE) = saved
+
+
+def new_collector(known_addresses=None):
+    """ Create an empty collector for the data gathered from the log lines """
+
+    return {
         "scan_count": 0,  # Number of lines scanned
         "parse_count": 0,  # Number of lines parsed (i.e. that had their contents examined)
         "scan_time": time.time(),  # The time in seconds the scan took
@@ -109,32 +598,673 @@ def scan_mail_log(env):
         "logins": OrderedDict(),  # Data about login activity
         "postgrey": {},  # Data about greylisting of email addresses
         "rejected": OrderedDict(),  # Emails that were blocked
-        "known_addresses": None,  # Addresses handled by the Miab installation
+        "activity": {  # Activity by hour of the sent_mail, received_mail and logins
+            "sent_mail": ActivityTable(),
+            "received_mail": ActivityTable(),
+            "logins": ActivityTable(),
+        },
+        "known_addresses": known_addresses,  # Addresses handled by the Miab installation
         "other-services": set(),
+        "abuse": AbuseDetector(),  # Bursts of suspicious activity
+        "queue": QueueTracker(),  # Delivery of the messages through the mail queue
     }
 
+
+class SampledList(list):
+    """ A list that keeps a uniform random sample of at most `size` of the items appended to it
+
+    This is reservoir sampling. The number of items that were appended is kept in `seen`.
+
+    """
+
+    __slots__ = ("size", "seen")
+
+    def __init__(self, size, items=(), seen=0):
+        super().__init__(items)
+        self.size = size
+        self.seen = seen
+
+    def __reduce__(self):
+        return self.__class__, (self.size, list(self), self.seen)
+
+    def append(self, item):
+        self.seen += 1
+        if len(self) < self.size:
+            super().append(item)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.size:
+                self[i] = item
+
+    def extend(self, items):
+        if not isinstance(items, SampledList):
+            for item in items:
+                self.append(item)
+            return
+
+        # Merge two samples, taking from each in proportion to the number of items it represents
+        seen = self.seen + items.seen
+        if len(self) + len(items) > self.size:
+            take = min(len(items), round(self.size * items.seen / seen))
+            keep = min(len(self), self.size - take)
+            self[:] = random.sample(list(self), keep) + random.sample(list(items), take)
+        else:
+            super().extend(items)
+        self.seen = seen
+
+
+class HeavyHitters(dict):
+    """ A dict that keeps at most `size` keys, the ones that are set most often
+
+    This is the space-saving algorithm. When a new key is set while the dict is full, the key that
+    was set least often is dropped and the new key takes over its count, so the counts in `counts`
+    are upper bounds.
+
+    The keys are kept in a heap to find the one to drop. There is a single entry per key, holding
+    the count of the key when it was pushed. Counts only grow, so a stale entry that comes up is
+    pushed again with the current count, and dropping a key takes O(log size) amortized time.
+
+    """
+
+    __slots__ = ("size", "counts", "heap", "serial")
+
+    def __init__(self, size, items=(), counts=None):
+        super().__init__(items)
+        self.size = size
+        self.counts = counts or {}
+        # (count, serial, key), the serial breaks ties in favor of the keys that were added first
+        self.heap = [(count, serial, key) for serial, (key, count) in enumerate(self.counts.items())]
+        heapq.heapify(self.heap)
+        self.serial = len(self.heap)
+
+    def __reduce__(self):
+        return self.__class__, (self.size, dict(self), self.counts)
+
+    def __setitem__(self, key, value):
+        self.add(key, value)
+
+    def add(self, key, value, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+        else:
+            if len(self) >= self.size:
+                while self.heap[0][0] != self.counts[self.heap[0][2]]:
+                    _, serial, stale = self.heap[0]
+                    heapq.heapreplace(self.heap, (self.counts[stale], serial, stale))
+                _, _, dropped = heapq.heappop(self.heap)
+                count += self.counts.pop(dropped)
+                super().__delitem__(dropped)
+            self.counts[key] = count
+            heapq.heappush(self.heap, (count, self.serial, key))
+            self.serial += 1
+        super().__setitem__(key, value)
+
+
+class ActivityTable:
+    """ Counters of the activity per user, protocol and hour of the day
+
+    The counters of a protocol are kept in one flat array, with a row of 24 counters per user, so
+    the totals by hour are sums over the strided columns of the array.
+
+    """
+
+    __slots__ = ("users", "columns")
+
+    def __init__(self, users=None, columns=None):
+        self.users = users or {}  # Row of every user
+        self.columns = columns or {}  # The array of counters of every protocol
+
+    def __reduce__(self):
+        return self.__class__, (self.users, self.columns)
+
+    def add(self, user, protocol_name, hour, count=1):
+        row = self.users.get(user)
+        if row is None:
+            row = self.users[user] = len(self.users)
+        counts = self.columns.get(protocol_name)
+        try:
+            counts[row * 24 + hour] += count
+        except (TypeError, IndexError):
+            # A new protocol or user, so grow the array up to the row of the user
+            if counts is None:
+                counts = self.columns[protocol_name] = array.array("I")
+            counts.frombytes(bytes(((row + 1) * 24 - len(counts)) * counts.itemsize))
+            counts[row * 24 + hour] += count
+
+    def row(self, user, protocol_name):
+        """ The counters by hour of a user """
+        row = self.users.get(user)
+        counts = self.columns.get(protocol_name, ())
+        if row is None or len(counts) < (row + 1) * 24:
+            return array.array("I", bytes(24 * 4))
+        return counts[row * 24:(row + 1) * 24]
+
+    def sums(self, users, protocol_name):
+        """ The total of the counters of every user """
+        return [sum(self.row(user, protocol_name)) for user in users]
+
+    def totals(self, protocol_name):
+        """ The counters by hour of all users together """
+        counts = self.columns.get(protocol_name, ())
+        return [sum(counts[hour::24]) for hour in range(24)]
+
+    def merge(self, other):
+        for protocol_name, counts in other.columns.items():
+            for user, row in other.users.items():
+                activity = counts[row * 24:(row + 1) * 24]
+                for hour in range(len(activity)):
+                    if activity[hour]:
+                        self.add(user, protocol_name, hour, activity[hour])
+
+
+class SlidingWindow:
+    """ Counts the events of the last ABUSE_WINDOW, in total and per value """
+
+    __slots__ = ("events", "values", "total")
+
+    def __init__(self):
+        self.events = deque()
+        self.values = defaultdict(int)
+        self.total = 0
+
+    def add(self, date, value=None, count=1):
+        self.events.append((date, value, count))
+        self.values[value] += count
+        self.total += count
+
+        while self.events[0][0] <= date - ABUSE_WINDOW:
+            _, value, count = self.events.popleft()
+            self.total -= count
+            self.values[value] -= count
+            if not self.values[value]:
+                del self.values[value]
+
+
+class AbuseDetector:
+    """ Flags bursts of suspicious activity while the log lines are scanned
+
+    The activity is counted in sliding windows as the lines come by, so no extra pass over the lines
+    is needed. The findings are kept per kind and subject (a user or an IP address), with the
+    highest count seen. This relies on the lines being fed in order.
+
+    Windows are dropped once they are empty, and only the ABUSE_MAX_USERS users that sent email
+    most recently keep their sending rate, so the memory use doesn't grow with the number of
+    subjects that ever showed up in the logs.
+
+    """
+
+    __slots__ = ("windows", "rates", "findings")
+
+    def __init__(self):
+        # The sliding window of every kind and subject, the least recently added to first
+        self.windows = OrderedDict()
+        # Per user, the least recently sending first: first hour, current hour, emails in that
+        # hour and before
+        self.rates = OrderedDict()
+        self.findings = OrderedDict()
+
+    def add_sent(self, date, user, client):
+        window = self.window("hosts", user, date)
+        window.add(date, client)
+        if len(window.values) > ABUSE_MAX_HOSTS:
+            self.flag("many hosts", user, date, len(window.values),
+                      "sent from {} hosts within an hour".format(len(window.values)))
+
+        # Compare the emails sent in this hour with the average of the earlier hours
+        hour = date.replace(minute=0, second=0)
+        first_hour, current_hour, count, before = self.rates.pop(user, (hour, hour, 0, 0))
+        if hour != current_hour:
+            current_hour, count, before = hour, 0, before + count
+        count += 1
+        self.rates[user] = (first_hour, current_hour, count, before)
+        if len(self.rates) > ABUSE_MAX_USERS:
+            self.rates.popitem(last=False)
+
+        hours = (current_hour - first_hour).total_seconds() // 3600
+        if hours >= ABUSE_BASELINE_HOURS:
+            baseline = before / hours
+            if count >= max(ABUSE_SPIKE_MIN, ABUSE_SPIKE_FACTOR * baseline):
+                self.flag("rate spike", user, date, count,
+                          "sent {} emails within an hour, against {:.1f} per hour before".format(
+                              count, baseline))
+
+    def add_failed_login(self, date, address, attempts=1):
+        window = self.window("failed logins", address, date)
+        window.add(date, count=attempts)
+        if window.total >= ABUSE_MAX_FAILED_LOGINS:
+            self.flag("failed logins", address, date, window.total,
+                      "{} failed logins within an hour".format(window.total))
+
+    def window(self, kind, subject, date):
+        # Nothing was added to these windows for ABUSE_WINDOW, so all of their events expired
+        while self.windows:
+            oldest = next(iter(self.windows.values()))
+            if oldest.events[-1][0] > date - ABUSE_WINDOW:
+                break
+            self.windows.popitem(last=False)
+
+        window = self.windows.get((kind, subject))
+        if window is None:
+            window = self.windows[(kind, subject)] = SlidingWindow()
+        else:
+            self.windows.move_to_end((kind, subject))
+        return window
+
+    def flag(self, kind, subject, date, count, detail):
+        finding = self.findings.get((kind, subject))
+        if finding is None:
+            self.findings[(kind, subject)] = {
+                "kind": kind,
+                "subject": subject,
+                "count": count,
+                "detail": detail,
+                "earliest": date,
+                "latest": date,
+            }
+            return
+
+        finding["latest"] = date
+        if count > finding["count"]:
+            finding["count"] = count
+            finding["detail"] = detail
+
+    def merge(self, other):
+        """ Merge the findings of a later part of the logs """
+
+        if other is self:
+            return
+
+        for key, finding in other.findings.items():
+            if key not in self.findings:
+                self.findings[key] = dict(finding)
+                continue
+
+            merged = self.findings[key]
+            merged["latest"] = finding["latest"]
+            if finding["count"] > merged["count"]:
+                merged["count"] = finding["count"]
+                merged["detail"] = finding["detail"]
+
+    def expire(self, date):
+        """ Forget the findings that were last seen before the date """
+
+        for key in [key for key, finding in self.findings.items() if finding["latest"] < date]:
+            del self.findings[key]
+
+
+class QueueTracker:
+    """ Follows the messages through the mail queue by their queue ID
+
+    The lines of smtpd (arrival), the queue manager (size, number of recipients and removal) and
+    lmtp and smtp (delivery) are joined while the lines are scanned. When a message is removed from
+    the queue, its latency (the longest delay of its deliveries, as logged by Postfix) is added to
+    the hour of the day it arrived in, and its final status is counted. The latency of every
+    delivery is also added to the domain of the recipient. This relies on the lines being fed in
+    order.
+
+    """
+
+    __slots__ = ("in_flight", "statuses", "size", "recipients", "expired", "by_hour", "by_domain")
+
+    def __init__(self):
+        # Per queue ID: arrival date, size, number of recipients, latency and status
+        self.in_flight = OrderedDict()
+        self.statuses = defaultdict(int)
+        self.size = 0
+        self.recipients = 0
+        self.expired = 0
+        self.by_hour = {}
+        self.by_domain = HeavyHitters(QUEUE_TOP_DOMAINS)
+
+    def get_record(self, date, queue_id):
+        """ Get the record of a message in the queue, adding it if it's new """
+
+        record = self.in_flight.get(queue_id)
+        if record is None:
+            self.expire(date)
+            record = self.in_flight[queue_id] = [date, 0, 0, 0.0, None]
+        return record
+
+    def arrived(self, date, queue_id):
+        self.get_record(date, queue_id)
+
+    def queued(self, date, queue_id, size, recipients):
+        record = self.get_record(date, queue_id)
+        record[1] = size
+        record[2] = recipients
+
+    def delivered(self, date, queue_id, recipient, delay, status):
+        if status == "deferred":
+            # Postfix will try again
+            return
+
+        domain = recipient.rpartition("@")[2].lower()
+        latencies = self.by_domain.get(domain) or SampledList(QUEUE_SAMPLES)
+        latencies.append(delay)
+        self.by_domain[domain] = latencies
+
+        record = self.in_flight.get(queue_id)
+        if record is not None:
+            record[3] = max(record[3], delay)
+            if record[4] in (None, "sent"):
+                # A message that wasn't delivered to every recipient keeps the first failure
+                record[4] = status
+
+    def removed(self, date, queue_id):
+        record = self.in_flight.pop(queue_id, None)
+        if record is None:
+            # It arrived before the time span
+            return
+
+        arrival, size, recipients, latency, status = record
+        self.statuses[status or "removed"] += 1
+        self.size += size
+        self.recipients += recipients
+
+        if status is not None:
+            self.by_hour.setdefault(arrival.hour, SampledList(QUEUE_SAMPLES)).append(latency)
+
+    def expire(self, date):
+        """ Drop the oldest messages when there are too many, or they outlived the queue """
+
+        while self.in_flight:
+            arrival = next(iter(self.in_flight.values()))[0]
+            if len(self.in_flight) < QUEUE_MAX_IN_FLIGHT and arrival >= date - QUEUE_EXPIRY:
+                break
+            self.in_flight.popitem(last=False)
+            self.expired += 1
+
+    def merge(self, other):
+        """ Merge the messages of a later part of the logs
+
+        Messages that were still in flight at the end of a part can't be followed into the next.
+
+        """
+
+        if other is self:
+            return
+
+        for status, count in other.statuses.items():
+            self.statuses[status] += count
+        self.size += other.size
+        self.recipients += other.recipients
+        self.expired += other.expired + len(other.in_flight)
+
+        for hour, latencies in other.by_hour.items():
+            self.by_hour.setdefault(hour, SampledList(QUEUE_SAMPLES)).extend(latencies)
+        for domain, latencies in other.by_domain.items():
+            merged = self.by_domain.get(domain) or SampledList(QUEUE_SAMPLES)
+            merged.extend(latencies)
+            self.by_domain.add(domain, merged, other.by_domain.counts[domain])
+
+
+def percentile(values, p):
+    """ The p-th percentile of the values, by the nearest-rank method """
+
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)] if values else None
+
+
+def get_known_addresses(env):
+    """ Get the addresses of the users and aliases, or None if they can't be looked up """
+
     try:
         import mailconfig
-        collector["known_addresses"] = (set(mailconfig.get_mail_users(env)) |
-                                        set(alias[0] for alias in mailconfig.get_mail_aliases(env)))
+        return (set(mailconfig.get_mail_users(env)) |
+                set(alias[0] for alias in mailconfig.get_mail_aliases(env)))
     except ImportError:
-        pass
+        return None
+
+
+def scan_mail_log(env):
+    """ Scan the system's mail log files and collect interesting data
+
+    This function scans the 2 most recent mail log files in /var/log/.
+
+    Args:
+        env (dict): Dictionary containing MiaB settings
+
+    """
 
     print("Scanning logs from {:%Y-%m-%d %H:%M:%S} to {:%Y-%m-%d %H:%M:%S}".format(
         END_DATE, START_DATE)
     )
 
-    # Scan the lines in the log files until the date goes out of range
-    scan_files(collector)
+    collector = collect_mail_log(env)
 
-    if not collector["scan_count"]:
+    if not collector["scan_count"] and not USE_INDEX:
         print("No log lines scanned...")
         return
 
+    if USE_INDEX:
+        print("{scan_count} new log lines scanned, {parse_count} lines parsed and the index "
+              "queried in {scan_time:.2f} seconds".format(**collector))
+    else:
+        print("{scan_count} Log lines scanned, {parse_count} lines parsed in {scan_time:.2f} "
+              "seconds".format(**collector))
+
+    if VERBOSE and collector["scan_time"] > 0:
+        print("{:.0f} lines/sec".format(collector["scan_count"] / collector["scan_time"]))
+
+    print()
+
+    print_report(collector)
+
+
+def collect_mail_log(env):
+    """ Scan the mail log files, or the index, into a new collector """
+
+    collector = new_collector(get_known_addresses(env))
+
+    if USE_INDEX:
+        # Only parse the log lines that were added since the last run and answer the report
+        # from the persistent index
+        update_index(env, collector)
+        load_index(env, collector)
+    else:
+        # Scan the lines in the log files until the date goes out of range
+        if JOBS > 1 and not (SCAN_ABUSE or SCAN_QUEUE):
+            # The abuse detection and the mail queue need to see the lines in order
+            scan_files_parallel(collector)
+        else:
+            scan_files(collector)
+
     collector["scan_time"] = time.time() - collector["scan_time"]
 
-    print("{scan_count} Log lines scanned, {parse_count} lines parsed in {scan_time:.2f} "
-          "seconds\n".format(**collector))
+    return collector
+
+
+def get_mail_log_data(env):
+    """ Scan the mail log files and return the report as plain data, ready to be serialised
+
+    The data is a dict with the time span, the line counts and, for every section that is scanned
+    for, a list of rows. Every row is a dict of plain values. Dates are formatted as strings.
+
+    """
+
+    collector = collect_mail_log(env)
+    data = get_report_header(collector)
+    data["sections"] = OrderedDict(iter_report_sections(collector))
+    return data
+
+
+def write_mail_log_data(env, output_format, output=sys.stdout):
+    """ Scan the mail log files and write the report as JSON or CSV
+
+    The sections are written one at a time, so only the rows of a single section are held in
+    memory. Anything printed while scanning goes to stderr, to keep it out of the data.
+
+    """
+
+    with contextlib.redirect_stdout(sys.stderr):
+        collector = collect_mail_log(env)
+
+    header = get_report_header(collector)
+
+    if output_format == "json":
+        output.write("{")
+        for key, value in header.items():
+            output.write("{}: {}, ".format(json.dumps(key), json.dumps(value)))
+        output.write('"sections": {')
+
+        for i, (name, rows) in enumerate(iter_report_sections(collector)):
+            output.write("{}{}: {}".format(", " if i else "", json.dumps(name), json.dumps(rows)))
+            output.flush()
+
+        output.write("}}\n")
+
+    elif output_format == "csv":
+        # Every section is a table of its own, the first column of which is the section name.
+        # Lists and dicts are written as JSON.
+        writer = csv.writer(output)
+        writer.writerow(header.keys())
+        writer.writerow(header.values())
+
+        for name, rows in iter_report_sections(collector):
+            if not rows:
+                continue
+
+            writer.writerow([])
+            writer.writerow(["section"] + list(rows[0].keys()))
+            for row in rows:
+                writer.writerow([name] + [json.dumps(value) if isinstance(value, (list, dict))
+                                          else value for value in row.values()])
+            output.flush()
+
+    else:
+        raise ValueError("Unknown output format: {}".format(output_format))
+
+
+def get_report_header(collector):
+    """ Get the time span and line counts of the report as plain data """
+
+    return OrderedDict([
+        ("start", format_date(END_DATE)),
+        ("end", format_date(START_DATE)),
+        ("scan_count", collector["scan_count"]),
+        ("parse_count", collector["parse_count"]),
+        ("scan_time", round(collector["scan_time"], 3)),
+    ])
+
+
+def iter_report_sections(collector):
+    """ A generator that returns the name and rows of every section of the report, one at a time
+
+    The rows only contain plain data, and are created when the section is reached.
+
+    """
+
+    def plain_date(date):
+        return None if date is None else format_date(date)
+
+    def by_hour(kind, user, protocol_name):
+        return list(collector["activity"][kind].row(user, protocol_name))
+
+    def users(kind):
+        return sorted(collector[kind].items(), key=email_sort)
+
+    if SCAN_OUT:
+        yield "sent", [{
+            "user": user,
+            "sent": u["sent_count"],
+            "hosts": sorted(u["hosts"]),
+            "earliest": plain_date(u["earliest"]),
+            "latest": plain_date(u["latest"]),
+            "activity_by_hour": by_hour("sent_mail", user, "sent"),
+        } for user, u in users("sent_mail")]
+
+    if SCAN_IN:
+        yield "received", [{
+            "user": user,
+            "received": u["received_count"],
+            "earliest": plain_date(u["earliest"]),
+            "latest": plain_date(u["latest"]),
+            "activity_by_hour": by_hour("received_mail", user, "received"),
+        } for user, u in users("received_mail")]
+
+    if SCAN_DOVECOT_LOGIN:
+        yield "logins", [{
+            "user": user,
+            "logins": dict(u["totals_by_protocol"]),
+            "hosts": [{"protocol": protocol_name, "host": host, "logins": count}
+                      for (protocol_name, host), count
+                      in sorted(u["totals_by_protocol_and_host"].items())],
+            "earliest": plain_date(u["earliest"]),
+            "latest": plain_date(u["latest"]),
+            "activity_by_hour": {protocol_name: by_hour("logins", user, protocol_name)
+                                 for protocol_name in u["totals_by_protocol"]},
+        } for user, u in users("logins")]
+
+    if SCAN_GREY:
+        if USE_INDEX:
+            # The index only has the counts
+            yield "greylisted", [{
+                "user": user,
+                "greylisted": u["count"],
+                "earliest": plain_date(u["earliest"]),
+                "latest": plain_date(u["latest"]),
+            } for user, u in users("postgrey")]
+        else:
+            yield "greylisted", [{
+                "user": user,
+                "client": client,
+                "sender": sender,
+                "greylisted": plain_date(first_date),
+                "delivered": plain_date(delivered_date),
+            } for user, u in users("postgrey")
+                for (client, sender), (first_date, delivered_date) in u.items()]
+
+    if SCAN_BLOCKED:
+        yield "blocked", [{
+            "user": user,
+            "blocked": u["count"],
+            "earliest": plain_date(u["earliest"]),
+            "latest": plain_date(u["latest"]),
+            "messages": [{"date": plain_date(date), "sender": sender, "message": message}
+                         for date, sender, message in u["blocked"]],
+        } for user, u in users("rejected")]
+
+    if SCAN_QUEUE:
+        queue = collector["queue"]
+
+        yield "queue", [{
+            "statuses": dict(queue.statuses),
+            "recipients": queue.recipients,
+            "size": queue.size,
+            "in_flight": len(queue.in_flight),
+            "expired": queue.expired,
+        }]
+
+        yield "latency_by_hour", [{
+            "hour": hour,
+            "messages": len(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        } for hour, latencies in sorted(queue.by_hour.items())]
+
+        yield "latency_by_domain", [{
+            "domain": domain,
+            "deliveries": latencies.seen,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        } for domain, latencies in sorted(queue.by_domain.items())]
+
+    if SCAN_ABUSE:
+        yield "abuse", [{
+            "subject": f["subject"],
+            "kind": f["kind"],
+            "peak": f["count"],
+            "detail": f["detail"],
+            "earliest": plain_date(f["earliest"]),
+            "latest": plain_date(f["latest"]),
+        } for f in sorted(collector["abuse"].findings.values(),
+                          key=lambda f: (f["subject"], f["kind"]))]
+
+
+def print_report(collector):
+    """ Print the report sections of the data in the collector """
 
     # Print Sent Mail report
 
@@ -143,6 +1273,7 @@ def scan_mail_log(env):
         print_header(msg)
 
         data = OrderedDict(sorted(collector["sent_mail"].items(), key=email_sort))
+        activity = collector["activity"]["sent_mail"]
 
         print_user_table(
             data.keys(),
@@ -151,24 +1282,18 @@ def scan_mail_log(env):
                 ("hosts", [len(u["hosts"]) for u in data.values()]),
             ],
             sub_data=[
-                ("sending hosts", [u["hosts"] for u in data.values()]),
+                ("sending hosts", [sorted(u["hosts"]) for u in data.values()]),
             ],
             activity=[
-                ("sent", [u["activity-by-hour"] for u in data.values()]),
+                ("sent", [activity.row(user, "sent") for user in data]),
             ],
             earliest=[u["earliest"] for u in data.values()],
             latest=[u["latest"] for u in data.values()],
         )
 
-        accum = defaultdict(int)
-        data = collector["sent_mail"].values()
-
-        for h in range(24):
-            accum[h] = sum(d["activity-by-hour"][h] for d in data)
-
         print_time_table(
             ["sent"],
-            [accum]
+            [activity.totals("sent")]
         )
 
     # Print Received Mail report
@@ -178,6 +1303,7 @@ def scan_mail_log(env):
         print_header(msg)
 
         data = OrderedDict(sorted(collector["received_mail"].items(), key=email_sort))
+        activity = collector["activity"]["received_mail"]
 
         print_user_table(
             data.keys(),
@@ -185,19 +1311,15 @@ def scan_mail_log(env):
                 ("received", [u["received_count"] for u in data.values()]),
             ],
             activity=[
-                ("sent", [u["activity-by-hour"] for u in data.values()]),
+                ("sent", [activity.row(user, "received") for user in data]),
             ],
             earliest=[u["earliest"] for u in data.values()],
             latest=[u["latest"] for u in data.values()],
         )
 
-        accum = defaultdict(int)
-        for h in range(24):
-            accum[h] = sum(d["activity-by-hour"][h] for d in data.values())
-
         print_time_table(
             ["received"],
-            [accum]
+            [activity.totals("received")]
         )
 
     # Print login report
@@ -207,22 +1329,21 @@ def scan_mail_log(env):
         print_header(msg)
 
         data = OrderedDict(sorted(collector["logins"].items(), key=email_sort))
+        activity = collector["activity"]["logins"]
+        totals = {protocol_name: activity.totals(protocol_name)
+                  for protocol_name in activity.columns}
 
         # Get a list of all of the protocols seen in the logs in reverse count order.
-        all_protocols = defaultdict(int)
-        for u in data.values():
-            for protocol_name, count in u["totals_by_protocol"].items():
-                all_protocols[protocol_name] += count
-        all_protocols = [k for k, v in sorted(all_protocols.items(), key=lambda kv : -kv[1])]
+        all_protocols = sorted(totals, key=lambda protocol_name: -sum(totals[protocol_name]))
+        seconds = [(u["latest"]-u["earliest"]).total_seconds() for u in data.values()]
 
         print_user_table(
             data.keys(),
             data=[
                 (protocol_name, [
-                    round(u["totals_by_protocol"][protocol_name] / (u["latest"]-u["earliest"]).total_seconds() * 60*60, 1)
-                    if (u["latest"]-u["earliest"]).total_seconds() > 0
+                    round(count / s * 60*60, 1) if s > 0
                     else 0 # prevent division by zero
-                  for u in data.values()])
+                  for count, s in zip(activity.sums(data, protocol_name), seconds)])
                 for protocol_name in all_protocols
             ],
             sub_data=[
@@ -233,7 +1354,7 @@ def scan_mail_log(env):
                   ] for u in data.values()])
             ],
             activity=[
-                (protocol_name, [u["activity-by-hour"][protocol_name] for u in data.values()])
+                (protocol_name, [activity.row(user, protocol_name) for user in data])
                 for protocol_name in all_protocols
             ],
             earliest=[u["earliest"] for u in data.values()],
@@ -241,14 +1362,9 @@ def scan_mail_log(env):
             numstr=lambda n : str(round(n, 1)),
         )
 
-        accum = { protocol_name: defaultdict(int) for protocol_name in all_protocols }
-        for h in range(24):
-            for protocol_name in all_protocols:
-              accum[protocol_name][h] = sum(d["activity-by-hour"][protocol_name][h] for d in data.values())
-
         print_time_table(
             all_protocols,
-            [accum[protocol_name] for protocol_name in all_protocols]
+            [totals[protocol_name] for protocol_name in all_protocols]
         )
 
     if collector["postgrey"]:
@@ -262,6 +1378,19 @@ def scan_mail_log(env):
         ), end='\n\n')
 
         data = OrderedDict(sorted(collector["postgrey"].items(), key=email_sort))
+
+    if collector["postgrey"] and USE_INDEX:
+        # The index only knows how many emails were greylisted
+        print_user_table(
+            data.keys(),
+            data=[
+                ("greylisted", [u["count"] for u in data.values()]),
+            ],
+            earliest=[u["earliest"] for u in data.values()],
+            latest=[u["latest"] for u in data.values()],
+        )
+
+    elif collector["postgrey"]:
         users = []
         received = []
         senders = []
@@ -300,7 +1429,8 @@ def scan_mail_log(env):
         if VERBOSE:
             for user_data in data.values():
                 user_rejects = []
-                for date, sender, message in user_data["blocked"]:
+                # A bounded sample isn't kept in order
+                for date, sender, message in sorted(user_data["blocked"], key=lambda b: b[0]):
                     if len(sender) > 64:
                         sender = sender[:32] + "…" + sender[-32:]
                     user_rejects.append("%s - %s " % (date, sender))
@@ -310,7 +1440,7 @@ def scan_mail_log(env):
         print_user_table(
             data.keys(),
             data=[
-                ("blocked", [len(u["blocked"]) for u in data.values()]),
+                ("blocked", [u["count"] for u in data.values()]),
             ],
             sub_data=[
                 ("blocked emails", rejects),
@@ -319,82 +1449,328 @@ def scan_mail_log(env):
             latest=[u["latest"] for u in data.values()],
         )
 
+    if collector["abuse"].findings:
+        msg = "Possible abuse {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S}"
+        print_header(msg.format(END_DATE, START_DATE))
+
+        findings = sorted(collector["abuse"].findings.values(),
+                          key=lambda f: (f["subject"], f["kind"]))
+
+        print_user_table(
+            [f["subject"] for f in findings],
+            data=[
+                ("suspicion", [f["kind"] for f in findings]),
+                ("peak", [f["count"] for f in findings]),
+            ],
+            sub_data=[
+                ("details", [[f["detail"]] for f in findings]),
+            ],
+            earliest=[f["earliest"] for f in findings],
+            latest=[f["latest"] for f in findings],
+        )
+
+    if SCAN_QUEUE and (collector["queue"].statuses or collector["queue"].in_flight):
+        queue = collector["queue"]
+        messages = sum(queue.statuses.values())
+
+        print_header("Mail queue")
+
+        if not messages:
+            print(" No messages left the queue in this time span. {} messages were still in the "
+                  "queue.".format(len(queue.in_flight)), end='\n\n')
+        else:
+            print(textwrap.fill(
+                "{} messages left the queue ({}), with {} recipients and {:.1f} kB on average. {} "
+                "messages were still in the queue, and {} were dropped before they left it.".format(
+                    messages,
+                    ", ".join("{} {}".format(count, status)
+                              for status, count in sorted(queue.statuses.items())),
+                    queue.recipients,
+                    queue.size / messages / 1024,
+                    len(queue.in_flight),
+                    queue.expired,
+                ),
+                width=80, initial_indent=" ", subsequent_indent=" "
+            ), end='\n\n')
+
+            print("Latency of the delivered messages in seconds, by the time of day they arrived:")
+            print_time_table(
+                ["messages", "p50", "p95", "p99"],
+                [[len(queue.by_hour.get(h, ())) for h in range(24)]] +
+                [[format_latency(percentile(queue.by_hour.get(h, ()), p)) for h in range(24)]
+                 for p in (50, 95, 99)]
+            )
+
+            domains = sorted(queue.by_domain, key=lambda d: -queue.by_domain.counts[d])
+
+            print()
+            print_user_table(
+                domains,
+                data=[
+                    ("deliveries", [queue.by_domain[d].seen for d in domains]),
+                    ("p50 (s)", [percentile(queue.by_domain[d], 50) for d in domains]),
+                    ("p95 (s)", [percentile(queue.by_domain[d], 95) for d in domains]),
+                    ("p99 (s)", [percentile(queue.by_domain[d], 99) for d in domains]),
+                ],
+                totals=False,
+            )
+
     if collector["other-services"] and VERBOSE and False:
         print_header("Other services")
         print("The following unkown services were found in the log file.")
         print(" ", *sorted(list(collector["other-services"])), sep='\n│ ')
 
 
+def follow_mail_log(env):
+    """ Follow the live log file and keep reporting the activity of the rolling time span
+
+    The lines are collected into buckets that each cover a part of the time span, and the buckets
+    are dropped once they fall out of it. The report merges the buckets that are left. It starts
+    with the lines of the live log file that are already in the time span.
+
+    """
+
+    global START_DATE, END_DATE
+
+    span = START_DATE - END_DATE
+    bucket_size = max(span / FOLLOW_BUCKETS, datetime.timedelta(seconds=1))
+    known_addresses = get_known_addresses(env)
+    buckets = {}
+    # The sliding windows of the abuse detection and the messages in the mail queue span the
+    # buckets, so the queue statistics cover everything since the start
+    detector = AbuseDetector()
+    tracker = QueueTracker()
+    next_report = 0
+
+    START_DATE = datetime.datetime.now()
+    END_DATE = START_DATE - span
+    set_now(START_DATE)
+    filename = LOG_FILES[-1]
+    offset = 0
+    if os.path.exists(filename):
+        offset = find_scan_offset(filename)
+        if offset is None:
+            # All of the lines are older than the time span, so only wait for new ones
+            offset = os.path.getsize(filename)
+
+    for line in follow_log_file(filename, offset):
+        if line is not None:
+            entry = parse_mail_log_line(line.strip())
+
+            if entry is not None and entry[0] < END_DATE:
+                # The year of the line was derived from NOW, which may be behind by now, e.g. when
+                # the year changed since the last report
+                now = datetime.datetime.now()
+                if now - NOW >= datetime.timedelta(seconds=1):
+                    set_now(now)
+                    entry = parse_mail_log_line(line.strip())
+
+            if entry is None or entry[0] < END_DATE:
+                continue
+
+            date, service, log = entry
+            bucket = date - (date - datetime.datetime.min) % bucket_size
+
+            if bucket not in buckets:
+                buckets[bucket] = new_collector(known_addresses)
+                buckets[bucket]["abuse"] = detector
+                buckets[bucket]["queue"] = tracker
+            buckets[bucket]["scan_count"] += 1
+            if scan_log_entry(date, service, log, buckets[bucket]):
+                buckets[bucket]["parse_count"] += 1
+
+        elif time.time() >= next_report:
+            START_DATE = datetime.datetime.now()
+            END_DATE = START_DATE - span
+            set_now(START_DATE)
+
+            collector = new_collector(known_addresses)
+            collector["abuse"] = detector
+            collector["queue"] = tracker
+            detector.expire(END_DATE)
+            for bucket in sorted(buckets):
+                if bucket + bucket_size <= END_DATE:
+                    del buckets[bucket]
+                else:
+                    # Merging hands over the data of the users, so merge copies of the buckets
+                    shared = (known_addresses, detector, tracker)
+                    merge_collectors(collector, copy.deepcopy(
+                        buckets[bucket], {id(obj): obj for obj in shared}))
+
+            print_follow_report(collector)
+            next_report = time.time() + FOLLOW_INTERVAL
+
+
+def print_follow_report(collector):
+    """ Print the activity of the rolling time span as a table or as a JSON line """
+
+    if FOLLOW == "json":
+        users = defaultdict(lambda: {"sent": 0, "received": 0, "logins": {}})
+        for user, data in collector["sent_mail"].items():
+            users[user]["sent"] = data["sent_count"]
+        for user, data in collector["received_mail"].items():
+            users[user]["received"] = data["received_count"]
+        for user, data in collector["logins"].items():
+            users[user]["logins"] = dict(data["totals_by_protocol"])
+
+        print(json.dumps({
+            "start": END_DATE.isoformat(),
+            "end": START_DATE.isoformat(),
+            "lines": collector["scan_count"],
+            "users": OrderedDict(sorted(users.items(), key=email_sort)),
+        }), flush=True)
+        return
+
+    if os.isatty(1):
+        # Clear the terminal, so the table refreshes in place
+        print("\033[H\033[J", end="")
+
+    print("Activity from {:%Y-%m-%d %H:%M:%S} to {:%Y-%m-%d %H:%M:%S}, {} log lines".format(
+        END_DATE, START_DATE, collector["scan_count"]))
+    print_report(collector)
+    print(flush=True)
+
+
 def scan_mail_log_line(line, collector):
     """ Scan a log line and extract interesting data """
 
-    m = re.match(r"(\w+[\s]+\d+ \d+:\d+:\d+) ([\w]+ )?([\w\-/]+)[^:]*: (.*)", line)
+    entry = parse_mail_log_line(line)
 
-    if not m:
+    if entry is None:
         return True
 
-    date, system, service, log = m.groups()
+    date, service, log = entry
     collector["scan_count"] += 1
 
+    # Check if the found date is within the time span we are scanning
+    # END_DATE < START_DATE
+    if date > START_DATE:
+        # Don't process, and halt
+        return False
+    elif date < END_DATE:
+        # Don't process, but continue
+        return True
+
+    if scan_log_entry(date, service, log, collector):
+        collector["parse_count"] += 1
+    return True
+
+
+def parse_mail_log_line(line):
+    """ Split a log line into its date, service and log message
+
+    Returns None if the line could not be parsed. The service and log message are None for the
+    lines of ignored services.
+
+    """
+
+    # Syslog lines start with a fixed width timestamp and the host name, after which the lines of
+    # uninteresting services can be recognized without running the full pattern
+    if line[15:16] == " ":
+        service_start = line.find(" ", 16) + 1
+        ignored = QUEUE_IGNORED_SERVICE_PREFIXES if SCAN_QUEUE else IGNORED_SERVICE_PREFIXES
+        if service_start and line.startswith(ignored, service_start):
+            date = parse_syslog_date(line[:15])
+            return None if date is None else (date, None, None)
+
+    m = LOG_LINE_PATTERN.match(line)
+
+    if not m:
+        return None
+
+    date, system, service, log = m.groups()
+
     # print()
     # print("date:", date)
     # print("host:", system)
     # print("service:", service)
     # print("log:", log)
 
-    # Replaced the dateutil parser for a less clever way of parser that is roughly 4 times faster.
-    # date = dateutil.parser.parse(date)
+    date = parse_syslog_date(date)
+    # print("date:", date)
 
-    # date = datetime.datetime.strptime(date, '%b %d %H:%M:%S')
-    # date = date.replace(START_DATE.year)
+    if date is None:
+        return None
 
-    # strptime fails on Feb 29 if correct year is not provided. See https://bugs.python.org/issue26460
-    date = datetime.datetime.strptime(str(START_DATE.year) + ' ' + date, '%Y %b %d %H:%M:%S')
-    # print("date:", date)
+    return date, service, log
 
-    # Check if the found date is within the time span we are scanning
-    # END_DATE < START_DATE
-    if date > START_DATE:
-        # Don't process, and halt
-        return False
-    elif date < END_DATE:
-        # Don't process, but continue
-        return True
 
-    if service == "postfix/submission/smtpd":
-        if SCAN_OUT:
-            scan_postfix_submission_line(date, log, collector)
-    elif service == "postfix/lmtp":
-        if SCAN_IN:
-            scan_postfix_lmtp_line(date, log, collector)
-    elif service.endswith("-login"):
-        if SCAN_DOVECOT_LOGIN:
-            scan_dovecot_login_line(date, log, collector, service[:4])
-    elif service == "postgrey":
-        if SCAN_GREY:
-            scan_postgrey_line(date, log, collector)
-    elif service == "postfix/smtpd":
-        if SCAN_BLOCKED:
-            scan_postfix_smtpd_line(date, log, collector)
-    elif service in ("postfix/qmgr", "postfix/pickup", "postfix/cleanup", "postfix/scache",
-                     "spampd", "postfix/anvil", "postfix/master", "opendkim", "postfix/lmtp",
-                     "postfix/tlsmgr", "anvil"):
+@functools.lru_cache(maxsize=1024)
+def parse_syslog_date(date):
+    """ Parse a syslog timestamp like 'Mar  8 23:59:42'
+
+    Parsing the dates used to be the most expensive part of scanning a line, but many lines share
+    the same timestamp, so the results are cached. The timestamps lack the year. It is assumed to
+    be the year of NOW, unless that would put the date more than a day after NOW, in which case the
+    line was logged the year before (i.e. NOW is in January and the line is from December). The
+    cached results depend on NOW, so set_now() clears the cache. Returns None if the timestamp is
+    not valid.
+
+    """
+
+    try:
+        month, day, time_of_day = date.split()
+        hour, minute, second = time_of_day.split(":")
+        month = MONTHS[month]
+    except (KeyError, ValueError):
+        return None
+
+    for year in (NOW.year, NOW.year - 1):
+        try:
+            date = datetime.datetime(year, month, int(day), int(hour), int(minute), int(second))
+        except ValueError:
+            # Feb 29 in a year that is not a leap year
+            continue
+
+        # Allow for some clock skew before deciding the date is in the future
+        if date <= NOW + datetime.timedelta(days=1):
+            return date
+
+    return None
+
+
+def set_now(now):
+    """ Move NOW, from which the years of the syslog timestamps are derived, to the given time """
+
+    global NOW
+
+    NOW = now
+    parse_syslog_date.cache_clear()
+
+
+def scan_log_entry(date, service, log, collector):
+    """ Hand a parsed log line to the scanner of its service
+
+    Returns True if the contents of the line were examined.
+
+    """
+
+    scanner = SERVICE_SCANNERS.get(service)
+
+    if scanner is not None:
+        # The scan flags can change at runtime, so they are looked up by name
+        flags, scan = scanner
+        if not any(globals()[flag] for flag in flags):
+            return False
+        scan(date, log, collector)
+    elif service is None or service in IGNORED_SERVICES:
         # nothing to look at
-        return True
+        return False
+    elif service.endswith("-login"):
+        if not (SCAN_DOVECOT_LOGIN or SCAN_ABUSE):
+            return False
+        scan_dovecot_login_line(date, log, collector, service[:4])
     else:
         collector["other-services"].add(service)
-        return True
+        return False
 
-    collector["parse_count"] += 1
     return True
 
 
 def scan_postgrey_line(date, log, collector):
     """ Scan a postgrey log line and extract interesting data """
 
-    m = re.match("action=(greylist|pass), reason=(.*?), (?:delay=\d+, )?client_name=(.*), "
-                 "client_address=(.*), sender=(.*), recipient=(.*)",
-                 log)
+    m = POSTGREY_PATTERN.match(log)
 
     if m:
 
@@ -412,7 +1788,9 @@ def scan_postgrey_line(date, log, collector):
 
             key = (client_address if client_name == 'unknown' else client_name, sender)
 
-            rep = collector["postgrey"].setdefault(user, {})
+            rep = collector["postgrey"].get(user)
+            if rep is None:
+                rep = collector["postgrey"][user] = HeavyHitters(BOUNDED_TOP_K) if BOUNDED else {}
 
             if action == "greylist" and reason == "new":
                 rep[key] = (date, rep[key][1] if key in rep else None)
@@ -423,11 +1801,14 @@ def scan_postgrey_line(date, log, collector):
 def scan_postfix_smtpd_line(date, log, collector):
     """ Scan a postfix smtpd log line and extract interesting data """
 
+    if SCAN_QUEUE:
+        scan_queue_line(date, log, collector)
+
     # Check if the incoming mail was rejected
 
-    m = re.match("NOQUEUE: reject: RCPT from .*?: (.*?); from=<(.*?)> to=<(.*?)>", log)
+    m = SMTPD_REJECT_PATTERN.match(log)
 
-    if m:
+    if m and SCAN_BLOCKED:
         message, sender, user = m.groups()
 
         # skip this, if reported in the greylisting report
@@ -440,45 +1821,52 @@ def scan_postfix_smtpd_line(date, log, collector):
                 data = collector["rejected"].get(
                     user,
                     {
-                        "blocked": [],
+                        "count": 0,
+                        "blocked": SampledList(BOUNDED_SAMPLES) if BOUNDED else [],
                         "earliest": None,
                         "latest": None,
                     }
                 )
                 # simplify this one
-                m = re.search(
-                    r"Client host \[(.*?)\] blocked using zen.spamhaus.org; (.*)", message
-                )
+                m = SPAMHAUS_IP_PATTERN.search(message)
                 if m:
                     message = "ip blocked: " + m.group(2)
                 else:
                     # simplify this one too
-                    m = re.search(
-                        r"Sender address \[.*@(.*)\] blocked using dbl.spamhaus.org; (.*)", message
-                    )
+                    m = SPAMHAUS_DOMAIN_PATTERN.search(message)
                     if m:
                         message = "domain blocked: " + m.group(2)
 
                 if data["earliest"] is None:
                     data["earliest"] = date
                 data["latest"] = date
+                data["count"] += 1
                 data["blocked"].append((date, sender, message))
 
                 collector["rejected"][user] = data
 
+    elif SCAN_ABUSE:
+        scan_sasl_failed_line(date, log, collector)
+
 
 def scan_dovecot_login_line(date, log, collector, protocol_name):
     """ Scan a dovecot login log line and extract interesting data """
 
-    m = re.match("Info: Login: user=<(.*?)>, method=PLAIN, rip=(.*?),", log)
+    m = DOVECOT_LOGIN_PATTERN.match(log)
 
     if m:
         # TODO: CHECK DIT
         user, host = m.groups()
 
-        if user_match(user):
+        if user_match(user) and SCAN_DOVECOT_LOGIN:
             add_login(user, date, protocol_name, host, collector)
 
+    elif SCAN_ABUSE:
+        m = DOVECOT_AUTH_FAILED_PATTERN.match(log)
+        if m:
+            attempts, host = m.groups()
+            collector["abuse"].add_failed_login(date, host, int(attempts))
+
 
 def add_login(user, date, protocol_name, host, collector):
             # Get the user data, or create it if the user is new
@@ -489,7 +1877,6 @@ def add_login(user, date, protocol_name, host, collector):
                     "latest": None,
                     "totals_by_protocol": defaultdict(int),
                     "totals_by_protocol_and_host": defaultdict(int),
-                    "activity-by-hour": defaultdict(lambda : defaultdict(int)),
                 }
             )
 
@@ -501,7 +1888,7 @@ def add_login(user, date, protocol_name, host, collector):
             data["totals_by_protocol_and_host"][(protocol_name, host)] += 1
 
             if host not in ("127.0.0.1", "::1") or True:
-                data["activity-by-hour"][protocol_name][date.hour] += 1
+                collector["activity"]["logins"].add(user, protocol_name, date.hour)
 
             collector["logins"][user] = data
 
@@ -514,7 +1901,10 @@ def scan_postfix_lmtp_line(date, log, collector):
 
     """
 
-    m = re.match("([A-Z0-9]+): to=<(\S+)>, .* Saved", log)
+    if SCAN_QUEUE:
+        scan_queue_line(date, log, collector)
+
+    m = LMTP_SAVED_PATTERN.match(log) if SCAN_IN else None
 
     if m:
         _, user = m.groups()
@@ -527,12 +1917,11 @@ def scan_postfix_lmtp_line(date, log, collector):
                     "received_count": 0,
                     "earliest": None,
                     "latest": None,
-                    "activity-by-hour": defaultdict(int),
                 }
             )
 
             data["received_count"] += 1
-            data["activity-by-hour"][date.hour] += 1
+            collector["activity"]["received_mail"].add(user, "received", date.hour)
 
             if data["earliest"] is None:
                 data["earliest"] = date
@@ -549,14 +1938,18 @@ def scan_postfix_submission_line(date, log, collector):
 
     """
 
-    # Match both the 'plain' and 'login' sasl methods, since both authentication methods are
-    # allowed by Dovecot
-    m = re.match("([A-Z0-9]+): client=(\S+), sasl_method=(PLAIN|LOGIN), sasl_username=(\S+)", log)
+    if SCAN_QUEUE:
+        scan_queue_line(date, log, collector)
+
+    m = SUBMISSION_PATTERN.match(log)
 
     if m:
         _, client, method, user = m.groups()
 
-        if user_match(user):
+        if user_match(user) and SCAN_ABUSE:
+            collector["abuse"].add_sent(date, user, client)
+
+        if user_match(user) and SCAN_OUT:
             # Get the user data, or create it if the user is new
             data = collector["sent_mail"].get(
                 user,
@@ -565,13 +1958,12 @@ def scan_postfix_submission_line(date, log, collector):
                     "hosts": set(),
                     "earliest": None,
                     "latest": None,
-                    "activity-by-hour": defaultdict(int),
                 }
             )
 
             data["sent_count"] += 1
             data["hosts"].add(client)
-            data["activity-by-hour"][date.hour] += 1
+            collector["activity"]["sent_mail"].add(user, "sent", date.hour)
 
             if data["earliest"] is None:
                 data["earliest"] = date
@@ -582,17 +1974,228 @@ def scan_postfix_submission_line(date, log, collector):
             # Also log this as a login.
             add_login(user, date, "smtp", client, collector)
 
+    elif SCAN_ABUSE:
+        scan_sasl_failed_line(date, log, collector)
+
+
+def scan_queue_line(date, log, collector):
+    """ Scan a postfix log line for a message entering, leaving or passing through the queue """
+
+    m = QUEUE_CLIENT_PATTERN.match(log)
+    if m:
+        collector["queue"].arrived(date, m.group(1))
+        return
+
+    m = QMGR_PATTERN.match(log)
+    if m:
+        queue_id, size, recipients, removed = m.groups()
+        if removed:
+            collector["queue"].removed(date, queue_id)
+        else:
+            collector["queue"].queued(date, queue_id, int(size), int(recipients))
+        return
+
+    m = DELIVERY_PATTERN.match(log)
+    if m:
+        queue_id, recipient, delay, status = m.groups()
+        collector["queue"].delivered(date, queue_id, recipient, float(delay), status)
+
+
+def scan_sasl_failed_line(date, log, collector):
+    """ Scan a postfix smtpd log line for a failed SASL login, for the abuse detection """
+
+    m = SASL_FAILED_PATTERN.match(log)
+
+    if m:
+        _, host = m.groups()
+        collector["abuse"].add_failed_login(date, host)
+
+
+# The scanners of the services with interesting log lines, with the names of the flags that enable
+# them
+SERVICE_SCANNERS = {
+    "postfix/submission/smtpd": (("SCAN_OUT", "SCAN_ABUSE", "SCAN_QUEUE"),
+                                 scan_postfix_submission_line),
+    "postfix/lmtp": (("SCAN_IN", "SCAN_QUEUE"), scan_postfix_lmtp_line),
+    "postgrey": (("SCAN_GREY",), scan_postgrey_line),
+    "postfix/smtpd": (("SCAN_BLOCKED", "SCAN_ABUSE", "SCAN_QUEUE"), scan_postfix_smtpd_line),
+    "postfix/qmgr": (("SCAN_QUEUE",), scan_queue_line),
+    "postfix/smtp": (("SCAN_QUEUE",), scan_queue_line),
+}
+
 # Utility functions
 
-def readline(filename):
-    """ A generator that returns the lines of a file
+def readline(filename, offset=0):
+    """ A generator that returns the lines of a file, starting at the given byte offset
+
+    Gzipped files (i.e. the rotated log files) are decompressed on the fly while reading, so they
+    never have to be copied to a temporary file first. They are always read from the start.
+
+    """
+    with open_log_file(filename) as file:
+        if offset and filename[-3:] != '.gz':
+            file.seek(offset)
+        yield from file
+
+
+def find_scan_offset(filename):
+    """ Find the byte offset to start scanning a log file from for the time span
+
+    Returns None if all lines of the file are older than END_DATE, so it can be skipped entirely.
+    Uncompressed files are bisected for the first line at or after END_DATE. Compressed files can
+    only be read from the start.
+
+    """
+
+    if filename[-3:] == '.gz':
+        # Finding the last line means decompressing the whole file, but the file was last modified
+        # when its last line was logged
+        if datetime.datetime.fromtimestamp(os.path.getmtime(filename)) < END_DATE:
+            return None
+        return 0
+
+    with open(filename, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+
+        _, last_date = read_line_date(file, max(0, size - BISECT_MIN_BYTES), last=True)
+        if last_date is not None and last_date < END_DATE:
+            return None
+
+        low, high = 0, size
+        while high - low > BISECT_MIN_BYTES:
+            middle = (low + high) // 2
+            start, date = read_line_date(file, middle)
+            if date is None or date >= END_DATE:
+                high = middle
+            else:
+                low = start
+
+    return low
+
+
+def read_line_date(file, offset, last=False):
+    """ Find the first (or last) line starting at or after the offset that has a date
+
+    Returns the byte offset the line starts at and its date, or None as the date if there is no
+    such line.
+
+    """
+
+    # Start at the beginning of the next line, unless the offset already is one
+    file.seek(max(0, offset - 1))
+    if offset:
+        file.readline()
+
+    found = (file.tell(), None)
+
+    while True:
+        start = file.tell()
+        line = file.readline()
+        if not line:
+            return found
+
+        entry = parse_mail_log_line(line.decode("utf-8", "replace").strip())
+        if entry is not None:
+            found = (start, entry[0])
+            if not last:
+                return found
+
+
+def follow_log_file(filename, offset=0):
+    """ A generator that returns the lines of a log file as they are written, like tail -F
+
+    When the file is rotated, the rest of the old file is read before continuing with the new one.
+    None is returned every time all lines written so far have been read, before waiting for more.
+
+    """
+
+    file = None
+    pending = b""
+
+    while True:
+        if file is None and os.path.exists(filename):
+            file = open(filename, 'rb')
+            file.seek(offset)
+
+        if file is not None:
+            for line in iter(file.readline, b""):
+                if line.endswith(b"\n"):
+                    yield (pending + line).decode("utf-8", "replace")
+                    pending = b""
+                else:
+                    # The rest of the line hasn't been written yet
+                    pending += line
+
+            try:
+                rotated = os.stat(filename).st_ino != os.fstat(file.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+
+            if rotated:
+                # Read what was written to the old file after the last read before moving on
+                for line in iter(file.readline, b""):
+                    yield (pending + line).decode("utf-8", "replace")
+                    pending = b""
+                file.close()
+                file, offset, pending = None, 0, b""
+                continue
+            elif os.fstat(file.fileno()).st_size < file.tell():
+                # The file was truncated
+                file.seek(0)
+                pending = b""
+
+        yield None
+        time.sleep(1)
+
+
+def open_gzip_file(filename):
+    """ Open a gzipped file for reading, with a read buffer as large as that of the plain files """
+    return io.BufferedReader(gzip.GzipFile(filename), READ_BUFFER_SIZE)
+
+
+def open_log_file(filename):
+    """ Open a log file for reading as text, decompressing it on the fly if it is gzipped """
+    if filename[-3:] == '.gz':
+        return io.TextIOWrapper(open_gzip_file(filename))
+    return open(filename, buffering=READ_BUFFER_SIZE)
+
+
+def read_new_lines(filename, offset):
+    """ A generator that returns the complete lines of a file starting at the given byte offset
+
+    The byte offset following each line is returned along with it, so reading can be resumed
+    there later. A trailing line that is still being written is left for the next time.
+
     """
-    with open(filename) as file:
-        while True:
-          line = file.readline()
-          if not line:
-              break
-          yield line
+    if filename[-3:] == '.gz':
+        file = open_gzip_file(filename)
+    else:
+        file = open(filename, 'rb', buffering=READ_BUFFER_SIZE)
+
+    with file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            yield line.decode("utf8", "replace"), offset
+
+
+def read_first_line(filename):
+    """ Return the first line of a (possibly gzipped) log file, to recognize it by """
+    with open_log_file(filename) as file:
+        return file.readline()
+
+
+def format_date(date):
+    """ Format a date the way it is stored in the index """
+    return date.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def parse_date(string):
+    """ Parse a date the way it is stored in the index """
+    return datetime.datetime(int(string[0:4]), int(string[5:7]), int(string[8:10]),
+                             int(string[11:13]), int(string[14:16]), int(string[17:19]))
 
 
 def user_match(user):
@@ -643,7 +2246,7 @@ def print_time_table(labels, data, do_print=True):
 
 
 def print_user_table(users, data=None, sub_data=None, activity=None, latest=None, earliest=None,
-                     delimit=False, numstr=str):
+                     delimit=False, numstr=str, totals=True):
     str_temp = "{:<32} "
     lines = []
     data = data or []
@@ -652,7 +2255,7 @@ def print_user_table(users, data=None, sub_data=None, activity=None, latest=None
     col_left = len(data) * [False]
     vert_pos = 0
 
-    do_accum = all(isinstance(n, (int, float)) for _, d in data for n in d)
+    do_accum = totals and all(isinstance(n, (int, float)) for _, d in data for n in d)
     data_accum = len(data) * ([0] if do_accum else [" "])
 
     last_user = None
@@ -786,6 +2389,10 @@ def print_user_table(users, data=None, sub_data=None, activity=None, latest=None
     print("\n".join(lines))
 
 
+def format_latency(latency):
+    return "-" if latency is None else "{:g}".format(latency)
+
+
 def print_header(msg):
     print('\n' + msg)
     print("═" * len(msg), '\n')
@@ -818,6 +2425,16 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--blocked", help="Scan for blocked emails.",
                         action="store_true")
 
+    parser.add_argument("-a", "--abuse", help="Report bursts of suspicious activity, like a user "
+                                              "sending from many hosts or at an unusual rate, "
+                                              "or many failed logins. Scans the files serially.",
+                        action="store_true")
+
+    parser.add_argument("-q", "--queue", help="Follow the messages through the mail queue and "
+                                              "report their delivery latency per hour and per "
+                                              "recipient domain. Scans the files serially.",
+                        action="store_true")
+
     parser.add_argument("-t", "--timespan", choices=TIME_DELTAS.keys(), default='today',
                         metavar='<time span>',
                         help="Time span to scan, going back from the start date. Possible values: "
@@ -831,44 +2448,92 @@ if __name__ == "__main__":
                         help="Comma separated list of (partial) email addresses to filter the "
                              "output with.")
 
+    parser.add_argument("-i", "--index", action="store_true",
+                        help="Only parse the log lines that are new since the last run into a "
+                             "persistent index and report from the index, with a resolution of an "
+                             "hour. Greylisted and blocked emails are only counted.")
+
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=1, metavar='<jobs>',
+                        help="Number of log files to scan in parallel. Defaults to 1. Not used "
+                             "together with the index.")
+
+    parser.add_argument("-f", "--follow", nargs='?', const='table', choices=('table', 'json'),
+                        help="Keep following the live log file and report the activity of a "
+                             "rolling time span, as a table or as a stream of JSON lines. The "
+                             "start date is ignored.")
+    parser.add_argument("--interval", action="store", type=int, default=FOLLOW_INTERVAL,
+                        metavar='<seconds>',
+                        help="Seconds between the reports when following the log file. Defaults "
+                             "to {}.".format(FOLLOW_INTERVAL))
+
+    parser.add_argument("--bounded", action="store_true",
+                        help="Keep the memory use flat when a lot of email is blocked or "
+                             "greylisted, by only keeping a random sample of {} blocked emails and "
+                             "the {} most frequent greylisted senders of every user.".format(
+                                 BOUNDED_SAMPLES, BOUNDED_TOP_K))
+
+    parser.add_argument("-o", "--format", choices=('table', 'json', 'csv'), default='table',
+                        help="Output format of the report. Defaults to 'table'.")
+
     parser.add_argument('-h', '--help', action='help', help="Print this message and exit.")
     parser.add_argument("-v", "--verbose", help="Output extra data where available.",
                         action="store_true")
 
     args = parser.parse_args()
 
+    # Keep the notes about the options out of machine readable output
+    note = print if args.format == 'table' else functools.partial(print, file=sys.stderr)
+
     if args.startdate is not None:
         START_DATE = args.startdate
         if args.timespan == 'today':
             args.timespan = 'day'
-        print("Setting start date to {}".format(START_DATE))
+        note("Setting start date to {}".format(START_DATE))
 
     END_DATE = START_DATE - TIME_DELTAS[args.timespan]
 
     VERBOSE = args.verbose
+    USE_INDEX = args.index
+    JOBS = max(1, args.jobs)
+    FOLLOW = args.follow
+    BOUNDED = args.bounded
+    FOLLOW_INTERVAL = max(1, args.interval)
 
     if args.received or args.sent or args.logins or args.grey or args.blocked:
         SCAN_IN = args.received
         if not SCAN_IN:
-            print("Ignoring received emails")
+            note("Ignoring received emails")
 
         SCAN_OUT = args.sent
         if not SCAN_OUT:
-            print("Ignoring sent emails")
+            note("Ignoring sent emails")
 
         SCAN_DOVECOT_LOGIN = args.logins
         if not SCAN_DOVECOT_LOGIN:
-            print("Ignoring logins")
+            note("Ignoring logins")
 
         SCAN_GREY = args.grey
         if SCAN_GREY:
-            print("Showing greylisted emails")
+            note("Showing greylisted emails")
 
         SCAN_BLOCKED = args.blocked
         if SCAN_BLOCKED:
-            print("Showing blocked emails")
+            note("Showing blocked emails")
+
+    SCAN_ABUSE = args.abuse
+    SCAN_QUEUE = args.queue
+    if (SCAN_ABUSE or SCAN_QUEUE) and USE_INDEX:
+        note("The index doesn't support the abuse detection and the mail queue")
 
     if args.users is not None:
         FILTERS = args.users.strip().split(',')
 
-    scan_mail_log(env_vars)
+    if FOLLOW:
+        try:
+            follow_mail_log(env_vars)
+        except KeyboardInterrupt:
+            pass
+    elif args.format != 'table':
+        write_mail_log_data(env_vars, args.format)
+    else:
+        scan_mail_log(env_vars)
@@ -9,11 +9,23 @@
 # Python 3 in setup/questions.sh to validate the email
 # address entered by the user.
 
-import subprocess, shutil, os, sqlite3, re
+import subprocess, shutil, os, stat, sqlite3, re, threading, queue, contextlib, atexit, hmac, time, collections
+import multiprocessing.pool
 import utils
 from email_validator import validate_email as validate_email_, EmailNotValidError
 import idna
 
+try:
+	# The crypt module is deprecated since Python 3.11 and removed in 3.13.
+	# Where it is missing, or its C library lacks an algorithm, passwords
+	# are hashed and checked by doveadm instead, as they used to be.
+	import warnings
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore", DeprecationWarning)
+		import crypt
+except ImportError:
+	crypt = None
+
 def validate_email(email, mode=None):
 	# Checks that an email address is syntactically valid. Returns True/False.
 	# Until Postfix supports SMTPUTF8, an email address may contain ASCII
@@ -91,19 +103,97 @@ def is_dcv_address(email):
 			return True
 	return False
 
-def open_database(env, with_connection=False):
-	conn = sqlite3.connect(env["STORAGE_ROOT"] + "/mail/users.sqlite")
-	if not with_connection:
-		return conn.cursor()
-	else:
-		return conn, conn.cursor()
+class DatabasePool:
+	# The connections to users.sqlite of this process. Reads borrow an idle
+	# connection, so that concurrent requests do not wait on each other. All
+	# writes go through a single connection, one transaction at a time. The
+	# connections are kept open and so keep their prepared statements.
+	#
+	# The database stays in rollback journal mode: Postfix, Dovecot and
+	# Roundcube open it as users that cannot create the -wal and -shm files
+	# WAL mode needs next to it.
+
+	max_idle_readers = 8
+
+	def __init__(self, path):
+		self.path = path
+		self.pid = os.getpid()
+		self.readers = queue.LifoQueue()
+		self.writer = None
+		self.write_lock = threading.Lock()
+
+	def connect(self, **kwargs):
+		return sqlite3.connect(self.path, check_same_thread=False, cached_statements=64, **kwargs)
+
+	@contextlib.contextmanager
+	def read(self):
+		try:
+			conn = self.readers.get_nowait()
+		except queue.Empty:
+			# In autocommit mode, so that an idle reader never holds a transaction.
+			conn = self.connect(isolation_level=None)
+			conn.execute("PRAGMA query_only = ON")
+		try:
+			yield conn.cursor()
+		finally:
+			if self.readers.qsize() < self.max_idle_readers:
+				self.readers.put(conn)
+			else:
+				conn.close()
+
+	@contextlib.contextmanager
+	def write(self):
+		with self.write_lock:
+			if self.writer is None:
+				self.writer = self.connect()
+			try:
+				yield self.writer.cursor()
+				self.writer.commit()
+			except:
+				self.writer.rollback()
+				raise
+
+	def close(self):
+		with self.write_lock:
+			if self.writer is not None:
+				self.writer.close()
+				self.writer = None
+		while not self.readers.empty():
+			self.readers.get_nowait().close()
+
+database_pools = { }
+database_pools_lock = threading.Lock()
+
+def get_database_pool(env):
+	path = os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite")
+	with database_pools_lock:
+		pool = database_pools.get(path)
+		if pool is None or pool.pid != os.getpid():
+			# A forked process must not share the connections of its parent,
+			# so leave those to the parent and start a pool of its own.
+			pool = database_pools[path] = DatabasePool(path)
+		return pool
+
+def open_database(env, write=False):
+	# Returns a context manager that gives a cursor to users.sqlite. Writes
+	# are committed when the block ends, or rolled back if it raises.
+	pool = get_database_pool(env)
+	return pool.write() if write else pool.read()
+
+@atexit.register
+def close_databases():
+	for pool in database_pools.values():
+		if pool.pid == os.getpid():
+			pool.close()
 
 def get_mail_users(env):
 	# Returns a flat, sorted list of all user accounts.
-	c = open_database(env)
-	c.execute('SELECT email FROM users')
-	users = [ row[0] for row in c.fetchall() ]
-	return utils.sort_email_addresses(users, env)
+	def load():
+		with open_database(env) as c:
+			c.execute('SELECT email FROM users')
+			users = [ row[0] for row in c.fetchall() ]
+		return utils.sort_email_addresses(users, env)
+	return list(utils.get_config_snapshot(env).get("mail_users", load))
 
 def get_mail_users_ex(env, with_archived=False):
 	# Returns a complex data structure of all user accounts, optionally
@@ -123,58 +213,79 @@ def get_mail_users_ex(env, with_archived=False):
 	#   },
 	#   ...
 	# ]
-
-	# Get users and their privileges.
-	users = []
-	active_accounts = set()
-	c = open_database(env)
-	c.execute('SELECT email, privileges FROM users')
-	for email, privileges in c.fetchall():
-		active_accounts.add(email)
-
-		user = {
-			"email": email,
-			"privileges": parse_privs(privileges),
-			"status": "active",
-		}
-		users.append(user)
-
-	# Add in archived accounts.
-	if with_archived:
-		root = os.path.join(env['STORAGE_ROOT'], 'mail/mailboxes')
-		for domain in os.listdir(root):
-			if os.path.isdir(os.path.join(root, domain)):
-				for user in os.listdir(os.path.join(root, domain)):
-					email = user + "@" + domain
-					mbox = os.path.join(root, domain, user)
-					if email in active_accounts: continue
-					user = {
+	return get_mail_users_page(env, with_archived=with_archived)[0]
+
+def get_mail_users_page(env, with_archived=False, domain=None, prefix=None, offset=0, limit=None):
+	# Returns a page of get_mail_users_ex: the accounts on domain whose
+	# address starts with prefix, skipping the first offset of them and with
+	# at most limit of them, and the total number of such accounts. Only the
+	# accounts on the page are read from the database.
+	domain, prefix, where, args = address_filter("email", domain, prefix)
+	with open_database(env) as c:
+		c.execute("SELECT domain, COUNT(*) FROM users %s GROUP BY domain" % where, args)
+		active_counts = dict(c.fetchall())
+
+		# Add in archived accounts, which still have a mailbox but no user.
+		inactive = { }
+		if with_archived:
+			c.execute("SELECT email FROM users %s" % where, args)
+			active_accounts = set(row[0] for row in c.fetchall())
+			root = os.path.join(env['STORAGE_ROOT'], 'mail/mailboxes')
+			for mailbox_domain, mailbox_users in get_mailbox_directories(env)[0].items():
+				if domain and mailbox_domain != domain: continue
+				emails = sorted(user + "@" + mailbox_domain for user in mailbox_users)
+				emails = [email for email in emails if email not in active_accounts and email.startswith(prefix)]
+				if emails:
+					inactive[mailbox_domain] = emails
+
+		counts = [(d, active_counts.get(d, 0) + len(inactive.get(d, [])))
+			for d in sort_idna_domains(set(active_counts) | set(inactive), env)]
+		page = get_page_slices(counts, offset, limit)
+
+		# When listing everything, read all of the accounts at once.
+		all_rows = None
+		if len(page) > 1 and len(page) == len(counts):
+			all_rows = { }
+			c.execute("SELECT domain, email, privileges FROM users %s ORDER BY email" % where, args)
+			for row in c.fetchall():
+				all_rows.setdefault(row[0], []).append(row[1:])
+
+		domains = []
+		for d, skip, take in page:
+			users = []
+
+			# Users on the domain, in order of their address, come first.
+			active = active_counts.get(d, 0)
+			if skip < active:
+				if all_rows is not None:
+					rows = all_rows[d][skip:skip + take]
+				else:
+					_, _, domain_where, domain_args = address_filter("email", d, prefix)
+					c.execute("SELECT email, privileges FROM users %s ORDER BY email LIMIT ? OFFSET ?" % domain_where,
+						domain_args + [min(take, active - skip), skip])
+					rows = c.fetchall()
+				for email, privileges in rows:
+					users.append({
 						"email": email,
-						"privileges": [],
-						"status": "inactive",
-						"mailbox": mbox,
-					}
-					users.append(user)
-
-	# Group by domain.
-	domains = { }
-	for user in users:
-		domain = get_domain(user["email"])
-		if domain not in domains:
-			domains[domain] = {
-				"domain": domain,
-				"users": []
-				}
-		domains[domain]["users"].append(user)
-
-	# Sort domains.
-	domains = [domains[domain] for domain in utils.sort_domains(domains.keys(), env)]
-
-	# Sort users within each domain first by status then lexicographically by email address.
-	for domain in domains:
-		domain["users"].sort(key = lambda user : (user["status"] != "active", user["email"]))
-
-	return domains
+						"privileges": parse_privs(privileges),
+						"status": "active",
+					})
+
+			# Then the archived accounts.
+			for email in inactive.get(d, [])[max(skip - active, 0):max(skip + take - active, 0)]:
+				users.append({
+					"email": email,
+					"privileges": [],
+					"status": "inactive",
+					"mailbox": os.path.join(root, d, email.split("@", 1)[0]),
+				})
+
+			domains.append({
+				"domain": get_domain("@" + d),
+				"users": users,
+			})
+
+	return domains, sum(count for d, count in counts)
 
 def get_admins(env):
 	# Returns a set of users with admin privileges.
@@ -187,13 +298,14 @@ def get_admins(env):
 
 def get_mail_aliases(env):
 	# Returns a sorted list of tuples of (address, forward-tos, permitted-senders).
-	c = open_database(env)
-	c.execute('SELECT source, destination, permitted_senders FROM aliases')
-	aliases = { row[0]: row for row in c.fetchall() } # make dict
+	def load():
+		with open_database(env) as c:
+			c.execute('SELECT source, destination, permitted_senders FROM aliases')
+			aliases = { row[0]: row for row in c.fetchall() } # make dict
 
-	# put in a canonical order: sort by domain, then by email address lexicographically
-	aliases = [ aliases[address] for address in utils.sort_email_addresses(aliases.keys(), env) ]
-	return aliases
+		# put in a canonical order: sort by domain, then by email address lexicographically
+		return [ aliases[address] for address in utils.sort_email_addresses(aliases.keys(), env) ]
+	return list(utils.get_config_snapshot(env).get("mail_aliases", load))
 
 def get_mail_aliases_ex(env):
 	# Returns a complex data structure of all mail aliases, similar
@@ -215,35 +327,151 @@ def get_mail_aliases_ex(env):
 	#   },
 	#   ...
 	# ]
-
-	required_aliases = get_required_aliases(env)
-	domains = {}
-	for address, forwards_to, permitted_senders in get_mail_aliases(env):
-		# get alias info
-		domain = get_domain(address)
-		required = (address in required_aliases)
-
-		# add to list
-		if not domain in domains:
-			domains[domain] = {
-				"domain": domain,
-				"aliases": [],
-			}
-		domains[domain]["aliases"].append({
-			"address": address,
-			"address_display": prettify_idn_email_address(address),
-			"forwards_to": [prettify_idn_email_address(r.strip()) for r in forwards_to.split(",")],
-			"permitted_senders": [prettify_idn_email_address(s.strip()) for s in permitted_senders.split(",")] if permitted_senders is not None else None,
-			"required": required,
-		})
-
-	# Sort domains.
-	domains = [domains[domain] for domain in utils.sort_domains(domains.keys(), env)]
-
-	# Sort aliases within each domain first by required-ness then lexicographically by address.
-	for domain in domains:
-		domain["aliases"].sort(key = lambda alias : (alias["required"], alias["address"]))
-	return domains
+	return get_mail_aliases_page(env)[0]
+
+def get_mail_aliases_page(env, domain=None, prefix=None, offset=0, limit=None):
+	# Returns a page of get_mail_aliases_ex, like get_mail_users_page.
+	domain, prefix, where, args = address_filter("source", domain, prefix)
+	with open_database(env) as c:
+		c.execute("SELECT domain, COUNT(*) FROM aliases %s GROUP BY domain" % where, args)
+		counts = dict(c.fetchall())
+		counts = [(d, counts[d]) for d in sort_idna_domains(counts, env)]
+		page = get_page_slices(counts, offset, limit)
+
+		# The required aliases on the domains of the page, or on all domains
+		# when the page has too many for an IN list.
+		real_mail_domains = get_real_mail_domains(c, [d for d, skip, take in page] if len(page) <= 500 else None)
+		required_aliases = set([get_system_administrator(env), "hostmaster@" + env['PRIMARY_HOSTNAME']])
+		for d in real_mail_domains:
+			required_aliases |= set(["postmaster@" + d, "admin@" + d, "abuse@" + d])
+
+		# When listing everything, read all of the aliases at once.
+		all_rows = None
+		if len(page) > 1 and len(page) == len(counts):
+			all_rows = { }
+			c.execute("SELECT domain, source, destination, permitted_senders FROM aliases %s" % where, args)
+			for row in c.fetchall():
+				all_rows.setdefault(row[0], []).append(row[1:])
+
+		domains = []
+		for d, skip, take in page:
+			# Sort aliases within each domain first by required-ness then lexicographically by address.
+			if all_rows is not None:
+				rows = sorted(all_rows[d], key = lambda row : (row[0] in required_aliases, row[0]))[skip:skip + take]
+			else:
+				_, _, domain_where, domain_args = address_filter("source", d, prefix)
+				domain_required = sorted(address for address in required_aliases if get_domain(address, as_unicode=False) == d)
+				order = "source IN (%s), source" % ", ".join("?" * len(domain_required)) if domain_required else "source"
+				c.execute("SELECT source, destination, permitted_senders FROM aliases %s ORDER BY %s LIMIT ? OFFSET ?" % (domain_where, order),
+					domain_args + domain_required + [take, skip])
+				rows = c.fetchall()
+
+			domains.append({
+				"domain": get_domain("@" + d),
+				"aliases": [
+					{
+						"address": address,
+						"address_display": prettify_idn_email_address(address),
+						"forwards_to": [prettify_idn_email_address(r.strip()) for r in forwards_to.split(",")],
+						"permitted_senders": [prettify_idn_email_address(s.strip()) for s in permitted_senders.split(",")] if permitted_senders is not None else None,
+						"required": address in required_aliases,
+					}
+					for address, forwards_to, permitted_senders in rows
+				],
+			})
+
+	return domains, sum(count for d, count in counts)
+
+def address_filter(column, domain=None, prefix=None):
+	# Returns the domain (IDNA-encoded) and address prefix to filter a listing
+	# by, and the WHERE clause and arguments that select the addresses in
+	# column on that domain and starting with that prefix.
+	conditions, args = [], []
+	if domain:
+		domain = get_domain(sanitize_idn_email_address("@" + domain.strip()), as_unicode=False).lower()
+		conditions.append("domain = ?")
+		args.append(domain)
+	prefix = (prefix or "").strip().lower()
+	if prefix:
+		# A range rather than LIKE, so that the index on the column is used.
+		conditions.append("%s >= ? AND %s < ?" % (column, column))
+		args.extend([prefix, prefix + "\U0010ffff"])
+	return domain, prefix, ("WHERE " + " AND ".join(conditions)) if conditions else "", args
+
+def sort_idna_domains(domains, env):
+	# Sorts IDNA-encoded domains in the order of their Unicode display names.
+	display_names = { get_domain("@" + d): d for d in domains }
+	return [display_names[d] for d in utils.sort_domains(display_names, env)]
+
+def get_page_slices(counts, offset, limit):
+	# counts are (domain, number of entries) in the order the domains are
+	# listed. Returns (domain, skip, take) for each domain with entries on the
+	# page: skip its first entries, then take that many.
+	stop = offset + limit if limit is not None else None
+	page = []
+	start = 0
+	for domain, count in counts:
+		first = max(start, offset)
+		last = start + count if stop is None else min(start + count, stop)
+		if last > first:
+			page.append((domain, first - start, last - first))
+		start += count
+		if stop is not None and start >= stop:
+			break
+	return page
+
+def get_real_mail_domains(c, domains=None):
+	# Returns the domains, of the given ones or of all, that have users or
+	# aliases other than the required aliases and catch-alls, which are the
+	# domains that need the required aliases (see get_required_aliases).
+	in_domains, args = "", []
+	if domains is not None:
+		if not domains:
+			return set()
+		in_domains = "AND domain IN (%s)" % ", ".join("?" * len(domains))
+		args = list(domains)
+	c.execute("SELECT domain FROM users WHERE 1 %s UNION SELECT domain FROM aliases WHERE substr(source, 1, instr(source, '@')) NOT IN ('postmaster@', 'admin@', 'abuse@', '@') %s" % (in_domains, in_domains),
+		args + args)
+	return set(row[0] for row in c.fetchall())
+
+mailbox_directories = { }
+mailbox_directories_lock = threading.Lock()
+
+def get_mailbox_directories(env):
+	# Returns the mailbox directories under STORAGE_ROOT/mail/mailboxes as
+	# { domain: [user, ...] }, and a version that changes whenever mailboxes
+	# are added or removed. The listing of each directory is kept until its
+	# mtime changes, so listing the accounts doesn't read every directory
+	# each time.
+	root = os.path.join(env['STORAGE_ROOT'], 'mail/mailboxes')
+	with mailbox_directories_lock:
+		root_mtime, domains = mailbox_directories.get(root, (None, { }))
+		mtime = os.stat(root).st_mtime_ns
+		if mtime != root_mtime:
+			domains = { domain: domains.get(domain, (None, [])) for domain in os.listdir(root) }
+
+		for domain, (domain_mtime, users) in list(domains.items()):
+			try:
+				st = os.stat(os.path.join(root, domain))
+			except FileNotFoundError:
+				st = None
+			if st is None or not stat.S_ISDIR(st.st_mode):
+				del domains[domain]
+			elif st.st_mtime_ns != domain_mtime:
+				domains[domain] = (st.st_mtime_ns, os.listdir(os.path.join(root, domain)))
+
+		mailbox_directories[root] = (mtime, domains)
+		version = hash((mtime, tuple(sorted((domain, domain_mtime) for domain, (domain_mtime, users) in domains.items()))))
+		return { domain: users for domain, (domain_mtime, users) in domains.items() }, version
+
+def get_mail_users_version(env, with_archived=False):
+	# Returns a value that changes whenever users.sqlite is written to and,
+	# with_archived, when mailboxes are added or removed, for a cheap check
+	# of whether a listing of users or aliases changed.
+	version = (utils.get_database_version(os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite")),)
+	if with_archived:
+		version += (get_mailbox_directories(env)[1],)
+	return version
 
 def get_domain(emailaddr, as_unicode=True):
 	# Gets the domain part of an email address. Turns IDNA
@@ -258,29 +486,37 @@ def get_domain(emailaddr, as_unicode=True):
 			pass
 	return ret
 
-def get_mail_domains(env, filter_aliases=lambda alias : True, users_only=False):
+def get_mail_domains(env, filter_aliases=None, users_only=False):
 	# Returns the domain names (IDNA-encoded) of all of the email addresses
 	# configured on the system. If users_only is True, only return domains
 	# with email addresses that correspond to user accounts.
-	domains = []
-	domains.extend([get_domain(login, as_unicode=False) for login in get_mail_users(env)])
-	if not users_only:
-		domains.extend([get_domain(address, as_unicode=False) for address, *_ in get_mail_aliases(env) if filter_aliases(address) ])
-	return set(domains)
+	def load():
+		domains = []
+		domains.extend([get_domain(login, as_unicode=False) for login in get_mail_users(env)])
+		if not users_only:
+			domains.extend([get_domain(address, as_unicode=False) for address, *_ in get_mail_aliases(env) if filter_aliases is None or filter_aliases(address) ])
+		return set(domains)
+	if filter_aliases is not None:
+		return load()
+	return set(utils.get_config_snapshot(env).get(("mail_domains", users_only), load))
+
+def validate_mail_user(email, pw, privs, env, first_user=None):
+	# Validates a new user account and returns its list of privileges. Raises
+	# a ValueError if the account is not valid. first_user says whether there
+	# are no user accounts yet, and is looked up if not given.
 
-def add_mail_user(email, pw, privs, env):
 	# validate email
 	if email.strip() == "":
-		return ("No email address provided.", 400)
+		raise ValueError("No email address provided.")
 	elif not validate_email(email):
-		return ("Invalid email address.", 400)
+		raise ValueError("Invalid email address.")
 	elif not validate_email(email, mode='user'):
-		return ("User account email addresses may only use the lowercase ASCII letters a-z, the digits 0-9, underscore (_), hyphen (-), and period (.).", 400)
-	elif is_dcv_address(email) and len(get_mail_users(env)) > 0:
+		raise ValueError("User account email addresses may only use the lowercase ASCII letters a-z, the digits 0-9, underscore (_), hyphen (-), and period (.).")
+	elif is_dcv_address(email) and not (first_user if first_user is not None else len(get_mail_users(env)) == 0):
 		# Make domain control validation hijacking a little harder to mess up by preventing the usual
 		# addresses used for DCV from being user accounts. Except let it be the first account because
 		# during box setup the user won't know the rules.
-		return ("You may not make a user account for that address because it is frequently used for domain control validation. Use an alias instead if necessary.", 400)
+		raise ValueError("You may not make a user account for that address because it is frequently used for domain control validation. Use an alias instead if necessary.")
 
 	# validate password
 	validate_password(pw)
@@ -292,26 +528,81 @@ def add_mail_user(email, pw, privs, env):
 		privs = privs.split("\n")
 		for p in privs:
 			validation = validate_privilege(p)
-			if validation: return validation
+			if validation: raise ValueError(validation[0])
 
-	# get the database
-	conn, c = open_database(env, with_connection=True)
+	return privs
+
+def add_mail_user(email, pw, privs, env, do_kick=True):
+	try:
+		privs = validate_mail_user(email, pw, privs, env)
+	except ValueError as e:
+		return (str(e), 400)
 
 	# hash the password
 	pw = hash_password(pw)
 
-	# add the user to the database
+	# add the user to the database, and write it before the next step
+	with open_database(env, write=True) as c:
+		try:
+			c.execute("INSERT INTO users (email, password, privileges, domain) VALUES (?, ?, ?, ?)",
+				(email, pw, "\n".join(privs), get_domain(email, as_unicode=False).lower()))
+		except sqlite3.IntegrityError:
+			return ("User already exists.", 400)
+
+	# Update things in case any new domains are added.
+	if not do_kick: return "mail user added"
+	return kick(env, "mail user added")
+
+def import_mail_users(users, env, do_kick=True):
+	# Adds many user accounts at once from a list of (email, password,
+	# privileges) tuples. All of them are validated first, and if any is
+	# not valid none are added. Large batches of passwords are hashed in
+	# parallel, the accounts are added in a single transaction and kick()
+	# is called once.
+	existing_users = set(get_mail_users(env))
+	new_users = []
+	errors = []
+
+	for i, (email, pw, privs) in enumerate(users, start=1):
+		try:
+			privs = validate_mail_user(email, pw, privs, env,
+				first_user=(len(existing_users) == 0 and len(new_users) == 0))
+			if email in existing_users:
+				raise ValueError("User already exists.")
+			existing_users.add(email)
+		except ValueError as e:
+			errors.append("Record %d (%s): %s" % (i, email, e))
+			continue
+		new_users.append((email, pw, privs))
+
+	if errors:
+		return ("".join(e + "\n" for e in errors), 400)
+	if len(new_users) == 0:
+		return ("No users to import.", 400)
+
+	# hash the passwords, several at a time for larger imports. This runs
+	# in the threaded daemon, so use threads rather than forking processes:
+	# crypt() releases the GIL while it works, as do doveadm subprocesses.
+	passwords = [pw for email, pw, privs in new_users]
+	if len(passwords) < 16:
+		hashes = [hash_password(pw) for pw in passwords]
+	else:
+		with multiprocessing.pool.ThreadPool(processes=os.cpu_count() or 1) as pool:
+			hashes = pool.map(hash_password, passwords, chunksize=8)
+
+	# add the users to the database, and write them before the next step
 	try:
-		c.execute("INSERT INTO users (email, password, privileges) VALUES (?, ?, ?)",
-			(email, pw, "\n".join(privs)))
+		with open_database(env, write=True) as c:
+			c.executemany("INSERT INTO users (email, password, privileges, domain) VALUES (?, ?, ?, ?)",
+				[(email, pw_hash, "\n".join(privs), get_domain(email, as_unicode=False).lower())
+				 for (email, pw, privs), pw_hash in zip(new_users, hashes)])
 	except sqlite3.IntegrityError:
-		return ("User already exists.", 400)
-
-	# write databasebefore next step
-	conn.commit()
+		return ("A user was added while importing. No users were imported.", 400)
 
 	# Update things in case any new domains are added.
-	return kick(env, "mail user added")
+	return_status = "%d mail users added" % len(new_users)
+	if not do_kick: return return_status
+	return kick(env, return_status)
 
 def set_mail_password(email, pw, env):
 	# validate that password is acceptable
@@ -321,40 +612,77 @@ def set_mail_password(email, pw, env):
 	pw = hash_password(pw)
 
 	# update the database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with open_database(env, write=True) as c:
+		c.execute("UPDATE users SET password=? WHERE email=?", (pw, email))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
 	return "OK"
 
+# The Dovecot password schemes that are crypt(3) hashes. The hash itself
+# tells crypt(3) which algorithm to use, e.g. $6$ for SHA512-CRYPT.
+CRYPT_SCHEMES = ("CRYPT", "MD5-CRYPT", "SHA256-CRYPT", "SHA512-CRYPT", "BLF-CRYPT")
+
 def hash_password(pw):
 	# Turn the plain password into a Dovecot-format hashed password, meaning
 	# something like "{SCHEME}hashedpassworddata".
 	# http://wiki2.dovecot.org/Authentication/PasswordSchemes
+	#
+	# Dovecot's SHA512-CRYPT is the crypt(3) of the C library with a random
+	# 16 character salt and the default number of rounds, which we can
+	# compute without starting doveadm.
+	if crypt is not None and crypt.METHOD_SHA512 in crypt.methods:
+		try:
+			pw_hash = crypt.crypt(pw, crypt.mksalt(crypt.METHOD_SHA512))
+		except (ValueError, OSError, UnicodeError):
+			pw_hash = None
+		# crypt(3) fails with None or a "*0" or "*1" token.
+		if pw_hash and not pw_hash.startswith("*"):
+			return "{SHA512-CRYPT}" + pw_hash
 	return utils.shell('check_output', ["/usr/bin/doveadm", "pw", "-s", "SHA512-CRYPT", "-p", pw]).strip()
 
+def verify_password(pw, pw_hash):
+	# Check a plain password against a Dovecot-format hashed password. The
+	# crypt(3) schemes are checked in-process. Other schemes, and algorithms
+	# the C library does not know (glibc has no BLF-CRYPT), are checked by
+	# doveadm, which returns a non-zero exit status if the password is wrong.
+	m = re.match(r"{([^}]+)}(.*)$", pw_hash)
+	if crypt is not None and m and m.group(1).upper() in CRYPT_SCHEMES:
+		try:
+			computed = crypt.crypt(pw, m.group(2))
+		except (ValueError, OSError, UnicodeError):
+			computed = None
+		# crypt(3) fails with None or a "*0" or "*1" token. Compare bytes:
+		# compare_digest takes only ASCII strings.
+		if computed and not computed.startswith("*"):
+			return hmac.compare_digest(computed.encode("utf8", "surrogateescape"), m.group(2).encode("utf8", "surrogateescape"))
+
+	try:
+		utils.shell('check_call', ["/usr/bin/doveadm", "pw", "-p", pw, "-t", pw_hash])
+	except Exception:
+		return False
+	return True
+
 def get_mail_password(email, env):
 	# Gets the hashed password for a user. Passwords are stored in Dovecot's
 	# password format, with a prefixed scheme.
 	# http://wiki2.dovecot.org/Authentication/PasswordSchemes
 	# update the database
-	c = open_database(env)
-	c.execute('SELECT password FROM users WHERE email=?', (email,))
-	rows = c.fetchall()
+	with open_database(env) as c:
+		c.execute('SELECT password FROM users WHERE email=?', (email,))
+		rows = c.fetchall()
 	if len(rows) != 1:
 		raise ValueError("That's not a user (%s)." % email)
 	return rows[0][0]
 
-def remove_mail_user(email, env):
+def remove_mail_user(email, env, do_kick=True):
 	# remove
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM users WHERE email=?", (email,))
-	if c.rowcount != 1:
-		return ("That's not a user (%s)." % email, 400)
-	conn.commit()
+	with open_database(env, write=True) as c:
+		c.execute("DELETE FROM users WHERE email=?", (email,))
+		if c.rowcount != 1:
+			return ("That's not a user (%s)." % email, 400)
 
 	# Update things in case any domains are removed.
+	if not do_kick: return "mail user removed"
 	return kick(env, "mail user removed")
 
 def parse_privs(value):
@@ -362,9 +690,9 @@ def parse_privs(value):
 
 def get_mail_user_privileges(email, env, empty_on_error=False):
 	# get privs
-	c = open_database(env)
-	c.execute('SELECT privileges FROM users WHERE email=?', (email,))
-	rows = c.fetchall()
+	with open_database(env) as c:
+		c.execute('SELECT privileges FROM users WHERE email=?', (email,))
+		rows = c.fetchall()
 	if len(rows) != 1:
 		if empty_on_error: return []
 		return ("That's not a user (%s)." % email, 400)
@@ -394,15 +722,19 @@ def add_remove_mail_user_privilege(email, priv, action, env):
 		return ("Invalid action.", 400)
 
 	# commit to database
-	conn, c = open_database(env, with_connection=True)
-	c.execute("UPDATE users SET privileges=? WHERE email=?", ("\n".join(privs), email))
-	if c.rowcount != 1:
-		return ("Something went wrong.", 400)
-	conn.commit()
+	with open_database(env, write=True) as c:
+		c.execute("UPDATE users SET privileges=? WHERE email=?", ("\n".join(privs), email))
+		if c.rowcount != 1:
+			return ("Something went wrong.", 400)
 
 	return "OK"
 
-def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exists=False, do_kick=True):
+def validate_mail_alias(address, forwards_to, permitted_senders, env, valid_logins=None):
+	# Validates an alias and returns its address, forwards_to and
+	# permitted_senders as they are stored in the database. Raises a
+	# ValueError if the alias is not valid. valid_logins are the user
+	# accounts, and are looked up if not given.
+
 	# convert Unicode domain to IDNA
 	address = sanitize_idn_email_address(address)
 
@@ -413,9 +745,9 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 	# validate address
 	address = address.strip()
 	if address == "":
-		return ("No email address provided.", 400)
+		raise ValueError("No email address provided.")
 	if not validate_email(address, mode='alias'):
-		return ("Invalid email address (%s)." % address, 400)
+		raise ValueError("Invalid email address (%s)." % address)
 
 	# validate forwards_to
 	validated_forwards_to = []
@@ -444,16 +776,17 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 				# Strip any +tag from email alias and check privileges
 				privileged_email = re.sub(r"(?=\+)[^@]*(?=@)",'',email)
 				if not validate_email(email):
-					return ("Invalid receiver email address (%s)." % email, 400)
+					raise ValueError("Invalid receiver email address (%s)." % email)
 				if is_dcv_source and not is_dcv_address(email) and "admin" not in get_mail_user_privileges(privileged_email, env, empty_on_error=True):
 					# Make domain control validation hijacking a little harder to mess up by
 					# requiring aliases for email addresses typically used in DCV to forward
 					# only to accounts that are administrators on this system.
-					return ("This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation.", 400)
+					raise ValueError("This alias can only have administrators of this system as destinations because the address is frequently used for domain control validation.")
 				validated_forwards_to.append(email)
 
 	# validate permitted_senders
-	valid_logins = get_mail_users(env)
+	if valid_logins is None:
+		valid_logins = get_mail_users(env)
 	validated_permitted_senders = []
 	permitted_senders = permitted_senders.strip()
 
@@ -464,14 +797,14 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 			login = login.strip()
 			if login == "": continue
 			if login not in valid_logins:
-				return ("Invalid permitted sender: %s is not a user on this system." % login, 400)
+				raise ValueError("Invalid permitted sender: %s is not a user on this system." % login)
 			validated_permitted_senders.append(login)
 
 	# Make sure the alias has either a forwards_to or a permitted_sender.
 	if len(validated_forwards_to) + len(validated_permitted_senders) == 0:
-		return ("The alias must either forward to an address or have a permitted sender.", 400)
+		raise ValueError("The alias must either forward to an address or have a permitted sender.")
 
-	# save to db
+	# format for the db
 
 	forwards_to = ",".join(validated_forwards_to)
 
@@ -480,60 +813,118 @@ def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exist
 	else:
 		permitted_senders = ",".join(validated_permitted_senders)
 
-	conn, c = open_database(env, with_connection=True)
+	return address, forwards_to, permitted_senders
+
+def add_mail_alias(address, forwards_to, permitted_senders, env, update_if_exists=False, do_kick=True):
 	try:
-		c.execute("INSERT INTO aliases (source, destination, permitted_senders) VALUES (?, ?, ?)", (address, forwards_to, permitted_senders))
-		return_status = "alias added"
-	except sqlite3.IntegrityError:
-		if not update_if_exists:
-			return ("Alias already exists (%s)." % address, 400)
-		else:
-			c.execute("UPDATE aliases SET destination = ?, permitted_senders = ? WHERE source = ?", (forwards_to, permitted_senders, address))
-			return_status = "alias updated"
+		address, forwards_to, permitted_senders = validate_mail_alias(address, forwards_to, permitted_senders, env)
+	except ValueError as e:
+		return (str(e), 400)
+
+	domain = get_domain(address, as_unicode=False)
 
-	conn.commit()
+	with open_database(env, write=True) as c:
+		try:
+			c.execute("INSERT INTO aliases (source, destination, permitted_senders, domain) VALUES (?, ?, ?, ?)", (address, forwards_to, permitted_senders, domain))
+			return_status = "alias added"
+		except sqlite3.IntegrityError:
+			if not update_if_exists:
+				return ("Alias already exists (%s)." % address, 400)
+			else:
+				c.execute("UPDATE aliases SET destination = ?, permitted_senders = ?, domain = ? WHERE source = ?", (forwards_to, permitted_senders, domain, address))
+				return_status = "alias updated"
 
 	if do_kick:
 		# Update things in case any new domains are added.
 		return kick(env, return_status)
+	return return_status
+
+def import_mail_aliases(aliases, env, update_if_exists=False, do_kick=True):
+	# Adds many aliases at once from a list of (address, forwards_to,
+	# permitted_senders) tuples, like import_mail_users.
+	valid_logins = set(get_mail_users(env))
+	existing_aliases = set(a for a, *_ in get_mail_aliases(env))
+	seen = set()
+	new_aliases = []
+	updated_aliases = []
+	errors = []
+
+	for i, (address, forwards_to, permitted_senders) in enumerate(aliases, start=1):
+		try:
+			alias = validate_mail_alias(address, forwards_to, permitted_senders, env, valid_logins)
+			if alias[0] in seen:
+				raise ValueError("The alias is imported twice.")
+			if alias[0] in existing_aliases and not update_if_exists:
+				raise ValueError("Alias already exists (%s)." % alias[0])
+			seen.add(alias[0])
+		except ValueError as e:
+			errors.append("Record %d (%s): %s" % (i, address, e))
+			continue
+		(updated_aliases if alias[0] in existing_aliases else new_aliases).append(
+			alias + (get_domain(alias[0], as_unicode=False),))
+
+	if errors:
+		return ("".join(e + "\n" for e in errors), 400)
+	if len(new_aliases) + len(updated_aliases) == 0:
+		return ("No aliases to import.", 400)
+
+	try:
+		with open_database(env, write=True) as c:
+			c.executemany("INSERT INTO aliases (source, destination, permitted_senders, domain) VALUES (?, ?, ?, ?)", new_aliases)
+			c.executemany("UPDATE aliases SET destination = ?, permitted_senders = ?, domain = ? WHERE source = ?",
+				[(forwards_to, permitted_senders, domain, address) for address, forwards_to, permitted_senders, domain in updated_aliases])
+	except sqlite3.IntegrityError:
+		return ("An alias was added while importing. No aliases were imported.", 400)
+
+	# Update things in case any new domains are added.
+	return_status = "%d aliases added, %d aliases updated" % (len(new_aliases), len(updated_aliases))
+	if not do_kick: return return_status
+	return kick(env, return_status)
 
 def remove_mail_alias(address, env, do_kick=True):
 	# convert Unicode domain to IDNA
 	address = sanitize_idn_email_address(address)
 
 	# remove
-	conn, c = open_database(env, with_connection=True)
-	c.execute("DELETE FROM aliases WHERE source=?", (address,))
-	if c.rowcount != 1:
-		return ("That's not an alias (%s)." % address, 400)
-	conn.commit()
+	with open_database(env, write=True) as c:
+		c.execute("DELETE FROM aliases WHERE source=?", (address,))
+		if c.rowcount != 1:
+			return ("That's not an alias (%s)." % address, 400)
 
 	if do_kick:
 		# Update things in case any domains are removed.
 		return kick(env, "alias removed")
+	return "alias removed"
 
 def get_system_administrator(env):
 	return "administrator@" + env['PRIMARY_HOSTNAME']
 
-def get_required_aliases(env):
-	# These are the aliases that must exist.
-	aliases = set()
+def get_required_aliases(env, users=None, aliases=None):
+	# These are the aliases that must exist. users and aliases are the
+	# addresses of the user accounts and aliases on the system, and are
+	# looked up if not given.
+	required = set()
 
 	# The system administrator alias is required.
-	aliases.add(get_system_administrator(env))
+	required.add(get_system_administrator(env))
 
 	# The hostmaster alias is exposed in the DNS SOA for each zone.
-	aliases.add("hostmaster@" + env['PRIMARY_HOSTNAME'])
+	required.add("hostmaster@" + env['PRIMARY_HOSTNAME'])
+
+	if users is None or aliases is None:
+		with open_database(env) as c:
+			if users is None:
+				c.execute('SELECT email FROM users')
+				users = [row[0] for row in c.fetchall()]
+			if aliases is None:
+				c.execute('SELECT source FROM aliases')
+				aliases = [row[0] for row in c.fetchall()]
 
 	# Get a list of domains we serve mail for, except ones for which the only
 	# email on that domain are the required aliases or a catch-all/domain-forwarder.
-	real_mail_domains = get_mail_domains(env,
-		filter_aliases = lambda alias :
-			not alias.startswith("postmaster@")
-			and not alias.startswith("admin@")
-			and not alias.startswith("abuse@")
-			and not alias.startswith("@")
-			)
+	real_mail_domains = set(get_domain(login, as_unicode=False) for login in users)
+	real_mail_domains.update(get_domain(address, as_unicode=False) for address in aliases
+		if not address.startswith(("postmaster@", "admin@", "abuse@", "@")))
 
 	# Create postmaster@, admin@ and abuse@ for all domains we serve
 	# mail on. postmaster@ is assumed to exist by our Postfix configuration.
@@ -541,12 +932,13 @@ def get_required_aliases(env):
 	# buying an SSL certificate.
 	# abuse@ is part of RFC2142: https://www.ietf.org/rfc/rfc2142.txt
 	for domain in real_mail_domains:
-		aliases.add("postmaster@" + domain)
-		aliases.add("admin@" + domain)
-		aliases.add("abuse@" + domain)
+		required.add("postmaster@" + domain)
+		required.add("admin@" + domain)
+		required.add("abuse@" + domain)
 
-	return aliases
+	return required
 
+@utils.serialized_system_update
 def kick(env, mail_result=None):
 	results = []
 
@@ -555,41 +947,38 @@ def kick(env, mail_result=None):
 	if mail_result is not None:
 		results.append(mail_result + "\n")
 
-	# Ensure every required alias exists.
-
-	existing_users = get_mail_users(env)
-	existing_alias_records = get_mail_aliases(env)
-	existing_aliases = set(a for a, *_ in existing_alias_records) # just first entry in tuple
-	required_aliases = get_required_aliases(env)
-
-	def ensure_admin_alias_exists(address):
-		# If a user account exists with that address, we're good.
-		if address in existing_users:
-			return
-
-		# If the alias already exists, we're good.
-		if address in existing_aliases:
-			return
-
-		# Doesn't exist.
-		administrator = get_system_administrator(env)
-		if address == administrator: return # don't make an alias from the administrator to itself --- this alias must be created manually
-		add_mail_alias(address, administrator, "", env, do_kick=False)
-		if administrator not in existing_aliases: return # don't report the alias in output if the administrator alias isn't in yet -- this is a hack to supress confusing output on initial setup
-		results.append("added alias %s (=> %s)\n" % (address, administrator))
-
-	for address in required_aliases:
-		ensure_admin_alias_exists(address)
-
-	# Remove auto-generated postmaster/admin on domains we no
-	# longer have any other email addresses for.
-	for address, forwards_to, *_ in existing_alias_records:
-		user, domain = address.split("@")
-		if user in ("postmaster", "admin", "abuse") \
-			and address not in required_aliases \
-			and forwards_to == get_system_administrator(env):
-			remove_mail_alias(address, env, do_kick=False)
-			results.append("removed alias %s (was to %s; domain no longer used for email)\n" % (address, forwards_to))
+	# Ensure every required alias exists, and remove the auto-generated
+	# postmaster/admin/abuse aliases on domains we no longer have any other
+	# email addresses for. Both are worked out from one snapshot of the
+	# users and aliases, and applied in the same transaction.
+
+	administrator = get_system_administrator(env)
+	with open_database(env, write=True) as c:
+		c.execute("BEGIN IMMEDIATE")
+		c.execute("SELECT email FROM users")
+		existing_users = set(row[0] for row in c.fetchall())
+		c.execute("SELECT source, destination FROM aliases")
+		existing_aliases = dict(c.fetchall())
+		required_aliases = get_required_aliases(env, existing_users, existing_aliases)
+
+		# Don't make an alias from the administrator to itself --- this alias must be created manually.
+		added_aliases = required_aliases - existing_users - existing_aliases.keys() - { administrator }
+		removed_aliases = [address for address, forwards_to in existing_aliases.items()
+			if address.split("@")[0] in ("postmaster", "admin", "abuse")
+			and address not in required_aliases
+			and forwards_to == administrator]
+
+		c.executemany("INSERT INTO aliases (source, destination, permitted_senders, domain) VALUES (?, ?, NULL, ?)",
+			[(address, administrator, get_domain(address, as_unicode=False)) for address in added_aliases])
+		c.executemany("DELETE FROM aliases WHERE source=?", [(address,) for address in removed_aliases])
+
+	# Don't report the aliases in output if the administrator alias isn't in
+	# yet -- this is a hack to supress confusing output on initial setup.
+	if administrator in existing_aliases:
+		for address in utils.sort_email_addresses(added_aliases, env):
+			results.append("added alias %s (=> %s)\n" % (address, administrator))
+	for address in utils.sort_email_addresses(removed_aliases, env):
+		results.append("removed alias %s (was to %s; domain no longer used for email)\n" % (address, administrator))
 
 	# Update DNS and nginx in case any domains are added/removed.
 
@@ -601,6 +990,96 @@ def kick(env, mail_result=None):
 
 	return "".join(s for s in results if s != "")
 
+class KickWorker:
+	# Runs kick() in a background thread so that API calls that change
+	# users or aliases don't wait for DNS and nginx to be updated. Changes
+	# that come in shortly after one another are collected into a single
+	# job, which calls kick() once for all of them. Jobs are numbered, and
+	# the status of the recent ones can be looked up by their ID.
+
+	delay = 2 # seconds without new changes before a job starts
+	max_delay = 10 # but a job never waits longer than this for more changes
+	max_jobs = 100 # finished jobs whose status is kept
+
+	def __init__(self, env):
+		self.env = env
+		self.cond = threading.Condition()
+		self.jobs = collections.OrderedDict()
+		self.next_id = 1
+		self.pending = None # the job that new changes are added to
+		self.thread = None
+
+	def schedule(self, mail_result):
+		# Adds a change to the pending job, starting one if there isn't
+		# one yet, and returns the job's ID.
+		with self.cond:
+			now = time.time()
+			job = self.pending
+			if job is None:
+				job = { "id": self.next_id, "status": "pending", "changes": [], "result": None, "created": now, "finished": None }
+				self.next_id += 1
+				self.jobs[job["id"]] = job
+				self.pending = job
+				while len(self.jobs) > self.max_jobs:
+					self.jobs.popitem(last=False)
+			job["changes"].append(mail_result)
+			job["updated"] = now
+
+			if self.thread is None or not self.thread.is_alive():
+				self.thread = threading.Thread(target=self.run, name="kick", daemon=True)
+				self.thread.start()
+			self.cond.notify_all()
+			return job["id"]
+
+	def run(self):
+		while True:
+			with self.cond:
+				while self.pending is None:
+					self.cond.wait()
+
+				# Wait until the changes stop coming in. Changes made once the
+				# job is running go into the next job, since kick() may have
+				# already read the users and aliases by then.
+				job = self.pending
+				while True:
+					start = min(job["updated"] + self.delay, job["created"] + self.max_delay)
+					if time.time() >= start: break
+					self.cond.wait(start - time.time())
+				self.pending = None
+				job["status"] = "running"
+
+			try:
+				result = kick(self.env, "\n".join(job["changes"]))
+				status = "finished"
+			except Exception as e:
+				result = "%s: %s\n" % (type(e).__name__, e)
+				status = "failed"
+
+			with self.cond:
+				job["status"] = status
+				job["result"] = result
+				job["finished"] = time.time()
+				self.cond.notify_all()
+
+	def get_job(self, job_id, wait=0):
+		# Returns the status of a job, or None if there is no such job. If wait
+		# is given, waits up to that many seconds for the job to be done.
+		with self.cond:
+			job = self.jobs.get(job_id)
+			if job is None:
+				return None
+			deadline = time.time() + wait
+			while job["status"] in ("pending", "running") and time.time() < deadline:
+				self.cond.wait(deadline - time.time())
+			return {
+				"id": job["id"],
+				"status": job["status"],
+				"changes": list(job["changes"]),
+				"result": job["result"],
+				"created": job["created"],
+				"finished": job["finished"],
+			}
+
 def validate_password(pw):
 	# validate password
 	if pw.strip() == "":
@@ -14,12 +14,12 @@ def get_user_id(email, c):
 	return r[0]
 
 def get_mfa_state(email, env):
-	c = open_database(env)
-	c.execute('SELECT id, type, secret, mru_token, label FROM mfa WHERE user_id=?', (get_user_id(email, c),))
-	return [
-		{ "id": r[0], "type": r[1], "secret": r[2], "mru_token": r[3], "label": r[4] }
-		for r in c.fetchall()
-	]
+	with open_database(env) as c:
+		c.execute('SELECT id, type, secret, mru_token, label FROM mfa WHERE user_id=?', (get_user_id(email, c),))
+		return [
+			{ "id": r[0], "type": r[1], "secret": r[2], "mru_token": r[3], "label": r[4] }
+			for r in c.fetchall()
+		]
 
 def get_public_mfa_state(email, env):
 	mfa_state = get_mfa_state(email, env)
@@ -45,24 +45,21 @@ def enable_mfa(email, type, secret, token, label, env):
 	else:
 		raise ValueError("Invalid MFA type.")
 
-	conn, c = open_database(env, with_connection=True)
-	c.execute('INSERT INTO mfa (user_id, type, secret, label) VALUES (?, ?, ?, ?)', (get_user_id(email, c), type, secret, label))
-	conn.commit()
+	with open_database(env, write=True) as c:
+		c.execute('INSERT INTO mfa (user_id, type, secret, label) VALUES (?, ?, ?, ?)', (get_user_id(email, c), type, secret, label))
 
 def set_mru_token(email, mfa_id, token, env):
-	conn, c = open_database(env, with_connection=True)
-	c.execute('UPDATE mfa SET mru_token=? WHERE user_id=? AND id=?', (token, get_user_id(email, c), mfa_id))
-	conn.commit()
+	with open_database(env, write=True) as c:
+		c.execute('UPDATE mfa SET mru_token=? WHERE user_id=? AND id=?', (token, get_user_id(email, c), mfa_id))
 
 def disable_mfa(email, mfa_id, env):
-	conn, c = open_database(env, with_connection=True)
-	if mfa_id is None:
-		# Disable all MFA for a user.
-		c.execute('DELETE FROM mfa WHERE user_id=?', (get_user_id(email, c),))
-	else:
-		# Disable a particular MFA mode for a user.
-		c.execute('DELETE FROM mfa WHERE user_id=? AND id=?', (get_user_id(email, c), mfa_id))
-	conn.commit()
+	with open_database(env, write=True) as c:
+		if mfa_id is None:
+			# Disable all MFA for a user.
+			c.execute('DELETE FROM mfa WHERE user_id=?', (get_user_id(email, c),))
+		else:
+			# Disable a particular MFA mode for a user.
+			c.execute('DELETE FROM mfa WHERE user_id=? AND id=?', (get_user_id(email, c), mfa_id))
 	return c.rowcount > 0
 
 def validate_totp_secret(secret):
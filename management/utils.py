@@ -1,4 +1,4 @@
-import os.path
+import os.path, threading, functools
 
 # DO NOT import non-standard modules. This module is imported by
 # migrate.py which runs on fresh machines before anything is installed
@@ -40,6 +40,89 @@ def load_settings(env):
     except:
         return { }
 
+# SERIALIZING SYSTEM CONFIGURATION UPDATES
+
+system_update_lock = threading.RLock()
+
+def serialized_system_update(func):
+    # Decorates a function that regenerates system configuration (zone
+    # files, nginx configuration, ...) so that only one such update runs
+    # at a time, whichever thread of the management daemon it runs on: a
+    # request thread or the background kick thread. The lock is reentrant
+    # because kick() calls do_dns_update() and do_web_update().
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with system_update_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+# THE CONFIGURATION SNAPSHOT
+
+def get_file_version(path):
+    # Returns a value that changes whenever the file at path is written to
+    # or replaced, or None if it doesn't exist.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def get_database_version(path):
+    # Like get_file_version, for a SQLite database in rollback journal mode.
+    # The file change counter in the database header goes up with every
+    # transaction that writes to it, which catches writes that leave the
+    # size as it was and come too soon after another to change the mtime.
+    try:
+        with open(path, "rb") as f:
+            f.seek(24)
+            return (get_file_version(path), f.read(4))
+    except FileNotFoundError:
+        return None
+
+class ConfigSnapshot:
+    # Values read or computed from the configuration that the mail, DNS and
+    # web domains are derived from: the users and aliases, the custom DNS
+    # records and the web customizations. A snapshot is shared until any of
+    # them change, so that each is read once however many functions use it.
+    # The values are shared too, so they must not be modified.
+
+    def __init__(self, version):
+        self.version = version
+        self.pid = os.getpid()
+        self.values = { }
+        self.lock = threading.RLock()
+
+    def get(self, key, load):
+        # Returns the value for key, calling load() for it the first time.
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = load()
+            return self.values[key]
+
+config_snapshots = { }
+config_snapshots_lock = threading.Lock()
+
+def get_config_snapshot(env):
+    version = (
+        get_database_version(os.path.join(env["STORAGE_ROOT"], "mail/users.sqlite")),
+        get_file_version(os.path.join(env["STORAGE_ROOT"], "dns/custom.yaml")),
+        get_file_version(os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")),
+        tuple(sorted(env.items())),
+    )
+    with config_snapshots_lock:
+        snapshot = config_snapshots.get(env["STORAGE_ROOT"])
+        # A forked process starts a snapshot of its own, in case the parent
+        # was in the middle of loading something when it forked.
+        if snapshot is None or snapshot.version != version or snapshot.pid != os.getpid():
+            snapshot = config_snapshots[env["STORAGE_ROOT"]] = ConfigSnapshot(version)
+        return snapshot
+
+def clear_config_snapshots():
+    # Called after writing a configuration file, in case the write left its
+    # size and mtime as they were.
+    with config_snapshots_lock:
+        config_snapshots.clear()
+
 # UTILITIES
 
 def safe_domain_name(name):
@@ -54,21 +137,21 @@ def sort_domains(domain_names, env):
     # domain name that we serve that ecompasses a set of subdomains. Map
     # each of the domain names to the zone that contains them. Walk the domains
     # from shortest to longest since zones are always shorter than their
-    # subdomains.
+    # subdomains, and look each of the domain's parent domains up among the
+    # zones found so far.
     zones = { }
     for domain in sorted(domain_names, key=lambda d : len(d)):
-        for z in zones.values():
-            if domain.endswith("." + z):
+        zones[domain] = domain
+        parent = domain
+        while "." in parent:
+            parent = parent.split(".", 1)[1]
+            if zones.get(parent) == parent:
                 # We found a parent domain already in the list.
-                zones[domain] = z
+                zones[domain] = parent
                 break
-        else:
-            # 'break' did not occur: there is no parent domain, so it is its
-            # own zone.
-            zones[domain] = domain
 
     # Sort the zones.
-    zone_domains = sorted(zones.values(),
+    zone_domains = sorted(set(zones.values()),
       key = lambda d : (
         # PRIMARY_HOSTNAME or the zone that contains it is always first.
         not (d == env['PRIMARY_HOSTNAME'] or env['PRIMARY_HOSTNAME'].endswith("." + d)),
@@ -76,12 +159,13 @@ def sort_domains(domain_names, env):
         # Then just dumb lexicographically.
         d,
       ))
+    zone_rank = { zone: i for i, zone in enumerate(zone_domains) }
 
     # Now sort the domain names that fall within each zone.
     domain_names = sorted(domain_names,
       key = lambda d : (
         # First by zone.
-        zone_domains.index(zones[d]),
+        zone_rank[zones[d]],
 
         # PRIMARY_HOSTNAME is always first within the zone that contains it.
         d != env['PRIMARY_HOSTNAME'],
@@ -96,14 +180,18 @@ def sort_domains(domain_names, env):
     return domain_names
 
 def sort_email_addresses(email_addresses, env):
-    email_addresses = set(email_addresses)
-    domains = set(email.split("@", 1)[1] for email in email_addresses if "@" in email)
+    # Group the addresses by domain, then put the domains in order.
+    domain_emails = { }
+    no_domain = [ ]
+    for email in set(email_addresses):
+        if "@" in email:
+            domain_emails.setdefault(email.split("@", 1)[1], []).append(email)
+        else:
+            no_domain.append(email)
     ret = []
-    for domain in sort_domains(domains, env):
-        domain_emails = set(email for email in email_addresses if email.endswith("@" + domain))
-        ret.extend(sorted(domain_emails))
-        email_addresses -= domain_emails
-    ret.extend(sorted(email_addresses)) # whatever is left
+    for domain in sort_domains(domain_emails, env):
+        ret.extend(sorted(domain_emails[domain]))
+    ret.extend(sorted(no_domain)) # whatever is left
     return ret
 
 def shell(method, cmd_args, env={}, capture_stderr=False, return_bytes=False, trap=False, input=None):
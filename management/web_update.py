@@ -7,9 +7,13 @@ import os.path, re, rtyaml
 from mailconfig import get_mail_domains
 from dns_update import get_custom_dns_config, get_dns_zones
 from ssl_certificates import get_ssl_certificates, get_domain_ssl_files, check_certificate
-from utils import shell, safe_domain_name, sort_domains
+from utils import shell, safe_domain_name, sort_domains, get_config_snapshot, serialized_system_update
 
 def get_web_domains(env, include_www_redirects=True, exclude_dns_elsewhere=True):
+	return list(get_config_snapshot(env).get(("web_domains", include_www_redirects, exclude_dns_elsewhere),
+		lambda : load_web_domains(env, include_www_redirects, exclude_dns_elsewhere)))
+
+def load_web_domains(env, include_www_redirects, exclude_dns_elsewhere):
 	# What domains should we serve HTTP(S) for?
 	domains = set()
 
@@ -27,8 +31,9 @@ def get_web_domains(env, include_www_redirects=True, exclude_dns_elsewhere=True)
 	# Add Autoconfiguration domains for domains that there are user accounts at:
 	# 'autoconfig.' for Mozilla Thunderbird auto setup.
 	# 'autodiscover.' for Activesync autodiscovery.
-	domains |= set('autoconfig.' + maildomain for maildomain in get_mail_domains(env, users_only=True))
-	domains |= set('autodiscover.' + maildomain for maildomain in get_mail_domains(env, users_only=True))
+	user_mail_domains = get_mail_domains(env, users_only=True)
+	domains |= set('autoconfig.' + maildomain for maildomain in user_mail_domains)
+	domains |= set('autodiscover.' + maildomain for maildomain in user_mail_domains)
 
 	# 'mta-sts.' for MTA-STS support for all domains that have email addresses.
 	domains |= set('mta-sts.' + maildomain for maildomain in get_mail_domains(env))
@@ -49,6 +54,9 @@ def get_web_domains(env, include_www_redirects=True, exclude_dns_elsewhere=True)
 	return domains
 
 def get_domains_with_a_records(env):
+	return set(get_config_snapshot(env).get("domains_with_a_records", lambda : load_domains_with_a_records(env)))
+
+def load_domains_with_a_records(env):
 	domains = set()
 	dns = get_custom_dns_config(env)
 	for domain, rtype, value in dns:
@@ -60,9 +68,8 @@ def get_web_domains_with_root_overrides(env):
 	# Load custom settings so we can tell what domains have a redirect or proxy set up on '/',
 	# which means static hosting is not happening.
 	root_overrides = { }
-	nginx_conf_custom_fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
-	if os.path.exists(nginx_conf_custom_fn):
-		custom_settings = rtyaml.load(open(nginx_conf_custom_fn))
+	custom_settings = get_web_custom_config(env)
+	if custom_settings is not None:
 		for domain, settings in custom_settings.items():
 			for type, value in [('redirect', settings.get('redirects', {}).get('/')),
 				('proxy', settings.get('proxies', {}).get('/'))]:
@@ -70,6 +77,16 @@ def get_web_domains_with_root_overrides(env):
 					root_overrides[domain] = (type, value)
 	return root_overrides
 
+def get_web_custom_config(env):
+	# Returns the user customizations in www/custom.yaml, or None if there
+	# is no such file. The result is shared and must not be modified.
+	def load():
+		nginx_conf_custom_fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
+		if os.path.exists(nginx_conf_custom_fn):
+			return rtyaml.load(open(nginx_conf_custom_fn))
+	return get_config_snapshot(env).get("web_custom", load)
+
+@serialized_system_update
 def do_web_update(env):
 	# Pre-load what SSL certificates we will use for each domain.
 	ssl_certificates = get_ssl_certificates(env)
@@ -150,9 +167,8 @@ def make_domain_config(domain, templates, ssl_certificates, env):
 
 	# Add in any user customizations in YAML format.
 	hsts = "yes"
-	nginx_conf_custom_fn = os.path.join(env["STORAGE_ROOT"], "www/custom.yaml")
-	if os.path.exists(nginx_conf_custom_fn):
-		yaml = rtyaml.load(open(nginx_conf_custom_fn))
+	yaml = get_web_custom_config(env)
+	if yaml is not None:
 		if domain in yaml:
 			yaml = yaml[domain]
 
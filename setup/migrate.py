@@ -186,6 +186,19 @@ def migration_13(env):
 	db = os.path.join(env["STORAGE_ROOT"], 'mail/users.sqlite')
 	shell("check_call", ["sqlite3", db, "CREATE TABLE mfa (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, type TEXT NOT NULL, secret TEXT NOT NULL, mru_token TEXT, label TEXT, FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE);"])
 
+def migration_14(env):
+	# Add an indexed domain column to the users and aliases tables. Postfix
+	# checks whether we handle mail for a domain on every incoming RCPT, and
+	# matching the addresses with LIKE '%@domain' scanned both tables.
+	db = os.path.join(env["STORAGE_ROOT"], 'mail/users.sqlite')
+	shell("check_call", ["sqlite3", db,
+		"ALTER TABLE users ADD domain TEXT;"
+		"ALTER TABLE aliases ADD domain TEXT;"
+		"UPDATE users SET domain=LOWER(SUBSTR(email, INSTR(email, '@') + 1));"
+		"UPDATE aliases SET domain=LOWER(SUBSTR(source, INSTR(source, '@') + 1));"
+		"CREATE INDEX users_domain ON users (domain);"
+		"CREATE INDEX aliases_domain ON aliases (domain);"])
+
 ###########################################################
 
 def get_current_migration():